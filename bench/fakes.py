@@ -0,0 +1,198 @@
+"""
+Локальные заглушки внешних сервисов для нагрузочного теста:
+Telegram Bot API, yandex_music.Client и yt-dlp. Задержки задаются
+переменными окружения BENCH_*_LATENCY_MS, чтобы их видели и
+дочерние процессы пула yt-dlp.
+"""
+import asyncio
+import itertools
+import os
+import time
+import uuid
+from collections import Counter
+
+from aiohttp import web
+
+
+def _latency(name: str) -> float:
+    return float(os.getenv(f"BENCH_{name}_LATENCY_MS", "0")) / 1000
+
+
+def _media_size() -> int:
+    return int(os.getenv("BENCH_MEDIA_SIZE_KB", "1024")) * 1024
+
+
+# ─── Telegram Bot API ───
+
+class FakeTelegram:
+    """
+    aiohttp-сервер, отвечающий на /bot<token>/<method> как Bot API.
+    Он же отдаёт «прямые ссылки» Яндекса (/media/...) и oEmbed YouTube (/oembed).
+    """
+
+    def __init__(self):
+        self.calls: Counter[str] = Counter()
+        self.url = ""
+        self._runner = None
+        self._message_ids = itertools.count(1)
+        self._payload = b"\0" * _media_size()
+
+    async def start(self, host: str = "127.0.0.1") -> str:
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_post("/bot{token}/{method}", self._handle_method)
+        app.router.add_get("/media/{name}", self._handle_media)
+        app.router.add_get("/oembed", self._handle_oembed)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def _message(self, **extra) -> dict:
+        return {"message_id": next(self._message_ids), "date": int(time.time()),
+                "chat": {"id": 1210881411, "type": "private"}, **extra}
+
+    async def _handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        self.calls[method] += 1
+        size = 0
+        async for chunk in request.content.iter_any():
+            size += len(chunk)
+        await asyncio.sleep(_latency("TG"))
+        file_id = f"bench-{uuid.uuid4().hex}"
+        if method == "getme":
+            result = {"id": 42, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method == "sendaudio":
+            result = self._message(audio={"file_id": file_id, "file_unique_id": file_id,
+                                          "duration": 180, "file_size": size})
+        elif method == "sendvideo":
+            result = self._message(video={"file_id": file_id, "file_unique_id": file_id, "duration": 180,
+                                          "width": 1280, "height": 720, "file_size": size})
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def _handle_media(self, request: web.Request) -> web.Response:
+        self.calls["media"] += 1
+        await asyncio.sleep(_latency("YM"))
+        return web.Response(body=self._payload, content_type="audio/mpeg")
+
+    async def _handle_oembed(self, request: web.Request) -> web.Response:
+        self.calls["oembed"] += 1
+        await asyncio.sleep(_latency("YT") / 10)
+        return web.json_response({
+            "title": "Bench video",
+            "author_name": "Bench channel",
+            "thumbnail_url": f"{self.url}/media/preview.jpg",
+        })
+
+
+# ─── yandex_music ───
+
+LYRICS = "\n".join(f"Строка {i} текста <песни> & припев" for i in range(120))
+
+
+class _Artist:
+    def __init__(self, name: str):
+        self.name = name
+
+
+class _Lyrics:
+    def fetch_lyrics(self) -> str:
+        time.sleep(_latency("YM"))
+        return LYRICS
+
+
+class _DownloadInfo:
+    bitrate_in_kbps = 192
+
+    def __init__(self, track_id: str):
+        self._track_id = track_id
+
+    def get_direct_link(self) -> str:
+        time.sleep(_latency("YM"))
+        return f"{FakeClient.media_base}/media/{self._track_id}.mp3"
+
+
+class _Track:
+    duration_ms = 180_000
+
+    def __init__(self, track_id: str):
+        self.id = track_id
+        self.title = f"Track {track_id}"
+        self.artists = [_Artist("Bench Artist")]
+
+    def get_lyrics(self):
+        return _Lyrics()
+
+    def get_specific_download_info(self, codec: str, bitrate: int):
+        time.sleep(_latency("YM"))
+        return _DownloadInfo(self.id)
+
+
+class FakeClient:
+    """Подменяет yandex_music.Client: блокирующие вызовы спят BENCH_YM_LATENCY_MS."""
+
+    media_base = ""
+
+    def __init__(self, token: str):
+        self.token = token
+
+    def init(self):
+        time.sleep(_latency("YM"))
+        return self
+
+    def tracks(self, track_ids):
+        time.sleep(_latency("YM"))
+        return [_Track(str(track_id)) for track_id in track_ids]
+
+    def search(self, query: str):
+        time.sleep(_latency("YM"))
+        return {"tracks": {"results": [
+            {"id": 1000 + i, "title": f"{query} #{i}", "artists": [{"name": "Bench Artist"}],
+             "cover_uri": "avatars.example/%%"}
+            for i in range(10)
+        ]}}
+
+
+# ─── yt-dlp (выполняется в процессах ytdlpWorker) ───
+
+def fake_extract(url: str, opts: dict) -> dict:
+    time.sleep(_latency("YT"))
+    return {"id": url, "formats": [
+        {"height": height, "vcodec": "avc1"} for height in (360, 720, 1080)
+    ]}
+
+
+def fake_run_ydl(url: str, opts: dict, progress_queue, info=None) -> None:
+    audio = any(p.get("key") == "FFmpegExtractAudio" for p in opts.get("postprocessors") or [])
+    path = opts["outtmpl"].replace("%(ext)s", "mp3" if audio else "mp4")
+    total = _media_size()
+    steps = 4
+    for step in range(1, steps + 1):
+        time.sleep(_latency("YT") / steps)
+        progress_queue.put_nowait({"status": "downloading", "downloaded": total * step // steps,
+                                   "total": total, "speed": None, "eta": None})
+    progress_queue.put_nowait({"status": "processing"})
+    with open(path, "wb") as f:
+        f.write(b"\0" * total)
+
+
+def install(telegram: FakeTelegram) -> None:
+    """Подменяет клиентов в модулях бота; вызывать после импорта main."""
+    import yandexApi
+    import youtubeModule
+    import ytdlpWorker
+
+    FakeClient.media_base = telegram.url
+    yandexApi.Client = FakeClient
+    youtubeModule.OEMBED = f"{telegram.url}/oembed"
+    # функции ищутся по имени модуля в дочерних процессах spawn-пула
+    ytdlpWorker._extract = fake_extract
+    ytdlpWorker._run_ydl = fake_run_ydl
@@ -0,0 +1,89 @@
+"""
+Микробенчмарк пагинатора текста песни: прежний посимвольный
+алгоритм против yandexModule._paginate_lyrics на длинных текстах.
+
+    python -m bench.lyrics --repeat 200
+"""
+import argparse
+import html
+import json
+import timeit
+from typing import List, Optional, Tuple
+
+from yandexModule import (
+    CAPTION_CLOSE_TAG, CAPTION_LIMIT, CAPTION_OPEN_TAG, _paginate_lyrics, _render_caption, _split_pages,
+)
+
+
+def legacy_build_caption_pages(raw_lyrics: str) -> List[str]:
+    """Прежняя реализация: экранирование и сборка страниц по одному символу."""
+    cleaned = raw_lyrics.strip()
+    if not cleaned:
+        return []
+    max_payload = CAPTION_LIMIT - len(CAPTION_OPEN_TAG) - len(CAPTION_CLOSE_TAG)
+    pages: List[str] = []
+    current_parts: List[str] = []
+    current_len = 0
+    last_break: Optional[Tuple[int, int]] = None
+    for char in cleaned:
+        escaped_char = html.escape(char)
+        escaped_len = len(escaped_char)
+        if current_len + escaped_len > max_payload and current_parts:
+            if last_break:
+                break_idx, break_len = last_break
+                chunk = "".join(current_parts[:break_idx])
+                pages.append(f"{CAPTION_OPEN_TAG}{chunk}{CAPTION_CLOSE_TAG}")
+                current_parts = current_parts[break_idx:]
+                current_len -= break_len
+            else:
+                pages.append(f"{CAPTION_OPEN_TAG}{''.join(current_parts)}{CAPTION_CLOSE_TAG}")
+                current_parts = []
+                current_len = 0
+            last_break = None
+        current_parts.append(escaped_char)
+        current_len += escaped_len
+        if char in ("\n", " "):
+            last_break = (len(current_parts), current_len)
+    if current_parts:
+        pages.append(f"{CAPTION_OPEN_TAG}{''.join(current_parts)}{CAPTION_CLOSE_TAG}")
+    return pages
+
+
+CASES = {
+    "song (3 KB)": "\n".join(f"Куплет {i}: я иду по улице, а город спит" for i in range(80)),
+    "long lyrics (60 KB)": "\n".join(f"Line {i} of a very long <live> version & more \"quotes\"" for i in range(1200)),
+    "markup-heavy (20 KB)": "<&>\"' " * 3500,
+    "no spaces (20 KB)": "a" * 20000,
+}
+
+
+def _check(text: str) -> None:
+    cleaned = text.strip()
+    info = {"lyrics": cleaned, "page_offsets": _paginate_lyrics(cleaned)}
+    pages = [_render_caption(page) for page in _split_pages(info)]
+    assert all(len(page) <= CAPTION_LIMIT for page in pages)
+    body = "".join(page[len(CAPTION_OPEN_TAG):-len(CAPTION_CLOSE_TAG)] for page in pages)
+    assert html.unescape(body) == cleaned
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарк пагинации текста песни")
+    parser.add_argument("--repeat", type=int, default=100)
+    args = parser.parse_args()
+
+    print(f"{'case':<22}{'pages':>7}{'legacy ms':>11}{'new ms':>9}{'speedup':>9}{'legacy B':>10}{'new B':>8}")
+    for name, text in CASES.items():
+        _check(text)
+        cleaned = text.strip()
+        legacy = timeit.timeit(lambda: legacy_build_caption_pages(text), number=args.repeat) / args.repeat
+        new = timeit.timeit(lambda: _paginate_lyrics(text.strip()), number=args.repeat) / args.repeat
+        legacy_pages = legacy_build_caption_pages(text)
+        # размер того, что уходит в кэш track_ym
+        legacy_size = len(json.dumps({"caption_pages": legacy_pages, "text": legacy_pages[0]}, ensure_ascii=False))
+        new_size = len(json.dumps({"lyrics": cleaned, "page_offsets": _paginate_lyrics(cleaned)}, ensure_ascii=False))
+        print(f"{name:<22}{len(_paginate_lyrics(cleaned)) - 1:>7}{legacy * 1000:>11.3f}{new * 1000:>9.3f}"
+              f"{legacy / new:>8.1f}x{legacy_size:>10}{new_size:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+Нагрузочный тест: синтетические инлайн-запросы и колбэки прогоняются
+через настоящий Dispatcher из main.py, внешние сервисы заменены
+заглушками из bench.fakes.
+
+    python -m bench.run --users 50 --duration 30 --tg-latency-ms 40
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import resource
+import statistics
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+
+from bench.fakes import FakeTelegram, install
+
+YM_QUERIES = ["rock", "jazz", "lofi", "metal", "pop", "indie", "blues", "techno"]
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на заглушках")
+    parser.add_argument("--users", type=int, default=20, help="одновременных пользователей")
+    parser.add_argument("--duration", type=float, default=20, help="длительность, с")
+    parser.add_argument("--think-ms", type=float, default=200, help="пауза пользователя между апдейтами")
+    parser.add_argument("--callback-ratio", type=float, default=0.1, help="доля колбэков скачивания")
+    parser.add_argument("--tracks", type=int, default=200, help="размер каталога треков и роликов")
+    parser.add_argument("--tg-latency-ms", type=float, default=30)
+    parser.add_argument("--ym-latency-ms", type=float, default=80)
+    parser.add_argument("--yt-latency-ms", type=float, default=500)
+    parser.add_argument("--media-size-kb", type=int, default=1024)
+    parser.add_argument("--redis", default="", help="REDIS_URL; без него кэши только локальные")
+    parser.add_argument("--tracemalloc", action="store_true", help="пик памяти Python-кучи (медленнее)")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+def _configure_env(args, workdir: str):
+    # main и модули читают настройки при импорте
+    os.environ.update({
+        "BOT_TOKEN": "42:bench",
+        "DB_DIR": workdir,
+        "MEDIA_DIR": os.path.join(workdir, "media"),
+        "METRICS_PORT": "0",
+        "DOWNLOAD_QUEUE": "0",
+        "BENCH_TG_LATENCY_MS": str(args.tg_latency_ms),
+        "BENCH_YM_LATENCY_MS": str(args.ym_latency_ms),
+        "BENCH_YT_LATENCY_MS": str(args.yt_latency_ms),
+        "BENCH_MEDIA_SIZE_KB": str(args.media_size_kb),
+    })
+
+
+class Traffic:
+    """Генератор апдейтов в формате Bot API."""
+
+    def __init__(self, args):
+        self.rng = random.Random(args.seed)
+        self.callback_ratio = args.callback_ratio
+        self.tracks = args.tracks
+        self._ids = 0
+
+    def _next_id(self) -> int:
+        self._ids += 1
+        return self._ids
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+    def next(self, user_id: int) -> tuple[str, dict]:
+        update_id = self._next_id()
+        if self.rng.random() < self.callback_ratio:
+            return self._callback(update_id, user_id)
+        kind, text = self.rng.choice([
+            ("inline_ym_search", lambda: f"ym {self.rng.choice(YM_QUERIES)}"),
+            ("inline_pref_search", lambda: self.rng.choice(YM_QUERIES)),
+            ("inline_ym_link", lambda: f"https://music.yandex.ru/track/{self._track()}"),
+            ("inline_yt_link", lambda: f"https://www.youtube.com/watch?v={self._video()}"),
+        ])
+        return kind, {"update_id": update_id, "inline_query": {
+            "id": str(update_id), "from": self._user(user_id), "query": text(), "offset": "",
+        }}
+
+    def _callback(self, update_id: int, user_id: int) -> tuple[str, dict]:
+        kind, data = self.rng.choice([
+            ("callback_ym_download", lambda: f"ym_dl:{self._track()}"),
+            ("callback_ym_page", lambda: f"ym_pg:{self._track()}:{user_id}:1"),
+            ("callback_yt_download", lambda: f"yt_dl:{self._video()}:audio"),
+        ])
+        return kind, {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "from": self._user(user_id), "chat_instance": "bench",
+            "inline_message_id": f"im{update_id}", "data": data(),
+        }}
+
+    def _track(self) -> int:
+        return self.rng.randrange(self.tracks) + 1
+
+    def _video(self) -> str:
+        return f"vid{self.rng.randrange(self.tracks):08d}"
+
+
+def _percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+def _report(latencies: dict, errors: dict, elapsed: float, telegram: FakeTelegram, traced_peak):
+    total = sum(len(v) for v in latencies.values())
+    print(f"\n{total} updates in {elapsed:.1f}s — {total / elapsed:.1f} updates/s")
+    print(f"{'kind':<22}{'count':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'mean ms':>10}")
+    inline = [x for kind, values in latencies.items() if kind.startswith("inline") for x in values]
+    rows = sorted(latencies.items()) + ([("inline (all)", inline)] if inline else [])
+    for kind, values in rows:
+        if not values:
+            continue
+        ms = [v * 1000 for v in values]
+        print(f"{kind:<22}{len(ms):>7}{errors.get(kind, 0):>8}{_percentile(ms, .5):>10.1f}"
+              f"{_percentile(ms, .95):>10.1f}{_percentile(ms, .99):>10.1f}{statistics.fmean(ms):>10.1f}")
+    # на Linux ru_maxrss в килобайтах
+    print(f"peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB")
+    if traced_peak is not None:
+        print(f"peak Python heap (tracemalloc): {traced_peak / 1024 ** 2:.1f} MiB")
+    print("Telegram API calls: " + ", ".join(f"{m}={n}" for m, n in telegram.calls.most_common()))
+
+
+async def run(args):
+    _configure_env(args, tempfile.mkdtemp(prefix="bench-"))
+    telegram = FakeTelegram()
+    os.environ["TELEGRAM_API_URL"] = await telegram.start()
+    if args.redis:
+        os.environ["REDIS_URL"] = args.redis
+
+    import httpClient
+    import main
+    import storage
+    from aiogram.types import Update
+
+    install(telegram)
+    if args.redis:
+        await main.start_services()
+    else:
+        await storage.init_db()
+        await httpClient.init_http_session()
+    bot = main.create_bot()
+    dp = main.create_dispatcher()
+
+    for user_id in range(1, args.users + 1):
+        await storage.save_ym_token(user_id, "y0_bench")
+        await storage.save_pref_service(user_id, "ym")
+
+    traffic = Traffic(args)
+    latencies: dict[str, list[float]] = defaultdict(list)
+    errors: dict[str, int] = defaultdict(int)
+    deadline = time.perf_counter() + args.duration
+
+    async def user(user_id: int):
+        await asyncio.sleep(random.random() * args.think_ms / 1000)
+        while time.perf_counter() < deadline:
+            kind, raw = traffic.next(user_id)
+            update = Update.model_validate(raw, context={"bot": bot})
+            started = time.perf_counter()
+            try:
+                await dp.feed_update(bot, update)
+            except Exception:
+                errors[kind] += 1
+            latencies[kind].append(time.perf_counter() - started)
+            await asyncio.sleep(args.think_ms / 1000)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(user(user_id) for user_id in range(1, args.users + 1)))
+    elapsed = time.perf_counter() - started
+    traced_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+
+    _report(latencies, errors, elapsed, telegram, traced_peak)
+    await bot.session.close()
+    if args.redis:
+        await main.stop_services()
+    else:
+        await storage.close_db()
+        await httpClient.close_http_session()
+    await telegram.stop()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.ERROR)
+    asyncio.run(run(_parse_args()))
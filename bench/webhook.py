@@ -0,0 +1,135 @@
+"""
+Сценарий режима webhook: запускает `python main.py` с BOT_MODE=webhook
+и WEB_WORKERS процессами на общем порту (SO_REUSEPORT) против заглушки
+Telegram и шлёт апдейты с секретом, без него и с неверным.
+
+    python -m bench.webhook --workers 2 --updates 200
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+from bench.fakes import FakeTelegram
+from bench.run import _percentile
+
+SECRET = "bench-secret"
+PATH = "/webhook"
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="Проверка и нагрузка вебхук-сервера на заглушке Telegram")
+    parser.add_argument("--workers", type=int, default=2, help="WEB_WORKERS")
+    parser.add_argument("--updates", type=int, default=100, help="апдейтов с верным секретом")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--startup-timeout", type=float, default=90)
+    return parser.parse_args()
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _update(update_id: int) -> dict:
+    # неподдерживаемая ссылка: бот отвечает answerInlineQuery, не трогая Redis и внешние сервисы;
+    # у каждого апдейта свой пользователь, иначе новый запрос отменяет предыдущий
+    return {"update_id": update_id, "inline_query": {
+        "id": str(update_id), "from": {"id": update_id, "is_bot": False, "first_name": "bench"},
+        "query": "https://example.com/", "offset": "",
+    }}
+
+
+async def _post(session: aiohttp.ClientSession, url: str, update_id: int, secret=None) -> int:
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret is not None else {}
+    async with session.post(url, json=_update(update_id), headers=headers) as response:
+        return response.status
+
+
+async def _wait_ready(session: aiohttp.ClientSession, url: str, process: subprocess.Popen, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"main.py exited with {process.returncode}")
+        try:
+            await _post(session, url, 0)
+            return
+        except aiohttp.ClientConnectionError:
+            await asyncio.sleep(0.5)
+    raise RuntimeError("webhook server did not start")
+
+
+async def run(args) -> int:
+    telegram = FakeTelegram()
+    api_url = await telegram.start()
+    port = _free_port()
+    workdir = tempfile.mkdtemp(prefix="bench-webhook-")
+    env = dict(
+        os.environ,
+        BOT_TOKEN="42:bench",
+        BOT_MODE="webhook",
+        TELEGRAM_API_URL=api_url,
+        WEBHOOK_URL="https://bench.invalid",
+        WEBHOOK_PATH=PATH,
+        WEBHOOK_SECRET=SECRET,
+        WEB_HOST="127.0.0.1",
+        WEB_PORT=str(port),
+        WEB_WORKERS=str(args.workers),
+        METRICS_PORT="0",
+        DB_DIR=workdir,
+        MEDIA_DIR=os.path.join(workdir, "media"),
+    )
+    process = subprocess.Popen([sys.executable, "main.py"], env=env)
+    url = f"http://127.0.0.1:{port}{PATH}"
+    failures = []
+    try:
+        async with aiohttp.ClientSession() as session:
+            await _wait_ready(session, url, process, args.startup_timeout)
+            for secret, expected in ((None, 401), ("wrong", 401), (SECRET, 200)):
+                status = await _post(session, url, 1, secret)
+                print(f"secret={secret!r:<16} -> HTTP {status}")
+                if status != expected:
+                    failures.append(f"secret={secret!r}: expected {expected}, got {status}")
+
+            answered = telegram.calls["answerinlinequery"]
+            semaphore = asyncio.Semaphore(args.concurrency)
+            latencies = []
+
+            async def send(update_id: int):
+                async with semaphore:
+                    started = time.perf_counter()
+                    status = await _post(session, url, update_id, SECRET)
+                    latencies.append(time.perf_counter() - started)
+                    if status != 200:
+                        failures.append(f"update {update_id}: HTTP {status}")
+
+            started = time.perf_counter()
+            await asyncio.gather(*(send(i) for i in range(2, args.updates + 2)))
+            elapsed = time.perf_counter() - started
+            # ответы на апдейты уходят из обработчиков; даём им дойти до заглушки
+            await asyncio.sleep(1)
+            handled = telegram.calls["answerinlinequery"] - answered
+            ms = [v * 1000 for v in latencies]
+            print(f"{args.updates} updates via {args.workers} workers in {elapsed:.2f}s "
+                  f"({args.updates / elapsed:.1f}/s), p50 {_percentile(ms, .5):.1f} ms, "
+                  f"p95 {_percentile(ms, .95):.1f} ms, answered {handled}")
+            if handled < args.updates:
+                failures.append(f"only {handled} of {args.updates} updates were answered")
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+        await telegram.stop()
+    for failure in failures:
+        print("FAIL:", failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(run(_parse_args())))
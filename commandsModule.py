@@ -7,7 +7,8 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from aiogram.enums import ParseMode
 
-from storage import save_ym_token, save_pref_service, get_pref_service
+from storage import save_ym_token, save_pref_service, get_pref_service, fetch_ym_token
+from yandexApi import drop_client
 
 router = Router()
 
@@ -82,7 +83,10 @@ async def save_user_token(msg: Message, state: FSMContext):
     if not re.match(r"^y0[-_0-9A-Za-z]+$", token):
         await msg.reply("Это не похоже на токен. Попробуйте снова.")
         return
+    old_token = await fetch_ym_token(msg.from_user.id)
     await save_ym_token(msg.from_user.id, token)
+    if old_token != token:
+        drop_client(old_token)
     await msg.reply("Токен сохранён!")
     await state.clear()
 
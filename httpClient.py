@@ -0,0 +1,34 @@
+import os
+from typing import Optional
+
+import aiohttp
+
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "100"))
+
+_session: Optional[aiohttp.ClientSession] = None
+
+
+async def init_http_session() -> aiohttp.ClientSession:
+    """Общая сессия с keep-alive и пулом соединений для метаданных (oEmbed и т.п.)."""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_SIZE,
+            keepalive_timeout=60,
+            ttl_dns_cache=300,
+        )
+        _session = aiohttp.ClientSession(connector=connector)
+    return _session
+
+
+async def get_session() -> aiohttp.ClientSession:
+    if _session is None or _session.closed:
+        return await init_http_session()
+    return _session
+
+
+async def close_http_session():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
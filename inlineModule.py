@@ -1,3 +1,8 @@
+import asyncio
+import os
+import time
+from typing import Optional
+
 from aiogram import Router
 from aiogram.types import (
     InlineQuery, InlineQueryResultArticle, InputTextMessageContent
@@ -5,6 +10,8 @@ from aiogram.types import (
 import yandexModule as ym
 import youtubeModule as yt
 import spotifyModule as sf
+from metrics import INLINE_LATENCY
+from tracing import span
 from storage import get_pref_service
 from yandexModule import answer_search as answer_search_ym
 from youtubeModule import answer_search as answer_search_yt
@@ -12,70 +19,145 @@ from spotifyModule import answer_search as answer_search_sf
 
 router = Router()
 
+INLINE_DEBOUNCE = float(os.getenv("INLINE_DEBOUNCE_MS", "150")) / 1000
+# user_id -> задача, обрабатывающая последний инлайн-запрос пользователя
+_inflight: dict[int, asyncio.Task] = {}
+
 
 @router.inline_query()
 async def handle_inline(query: InlineQuery):
+    """
+    Telegram шлёт новый запрос почти на каждое нажатие клавиши.
+    Более новый запрос отменяет незавершённую обработку предыдущего,
+    поэтому до сервисов доходит только актуальный текст.
+    """
+    user_id = query.from_user.id
+    previous = _inflight.get(user_id)
+    if previous is not None and not previous.done():
+        previous.cancel()
+    task = asyncio.create_task(_debounced(query))
+    _inflight[user_id] = task
+    try:
+        await asyncio.wait({task})
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        if _inflight.get(user_id) is task:
+            del _inflight[user_id]
+    if not task.cancelled():
+        task.result()
+
+
+async def _debounced(query: InlineQuery):
     text = query.query.strip()
+    service, branch = _route(text)
+    status = "error"
+    # отсчёт до паузы: метрика показывает задержку, которую видит пользователь
+    started = time.perf_counter()
+    try:
+        # ждём только поиск, который набирают по буквам; ссылку вставляют целиком
+        if branch in ("search", "pref") and INLINE_DEBOUNCE > 0:
+            await asyncio.sleep(INLINE_DEBOUNCE)
+        if branch == "pref":
+            service = _pref_label(await get_pref_service(query.from_user.id))
+        with span(f"inline.{service}.{branch}"):
+            await _answer_inline(query, text, service, branch)
+        status = "ok"
+    except asyncio.CancelledError:
+        status = "cancelled"
+        raise
+    finally:
+        INLINE_LATENCY.labels(service, branch, status).observe(time.perf_counter() - started)
+
+
+def _route(text: str) -> tuple[str, str]:
+    """
+    (service, branch) запроса. Для branch="pref" (поиск через предпочитаемый
+    сервис) service становится известен только после чтения настроек.
+    """
     if text.startswith("https://"):
         if "yandex.ru" in text:
-            track_id = ym.parse_track_id(text)
-            if track_id:
-                await ym.answer_download(query, track_id)
-            else:
+            return "ym", "link"
+        if yt.is_youtube_link(text):
+            return "yt", "link"
+        if sf.is_spotify_link(text):
+            return "sf", "link"
+        return "unsupported", "link"
+    for prefix in ("ym", "yt", "sf"):
+        if text.startswith(f"{prefix} "):
+            return prefix, "search"
+    if text == "":
+        return "none", "search"
+    return "pref", "pref"
+
+
+def _pref_label(pref: Optional[str]) -> str:
+    if pref is None:
+        return "none"
+    return pref if pref in ("ym", "yt", "sf") else "unknown"
+
+
+async def _answer_inline(query: InlineQuery, text: str, service: str, branch: str):
+    if branch == "link":
+        match service:
+            case "ym":
+                track_id = ym.parse_track_id(text)
+                if track_id:
+                    await ym.answer_download(query, track_id)
+                else:
+                    await query.answer([
+                        InlineQueryResultArticle(
+                            id="bad_link",
+                            title="Ссылка не ведет на трек",
+                            description="Не удалось найти track_id",
+                            input_message_content=InputTextMessageContent(message_text="ссылка не ведет на трек"),
+                        )
+                    ], cache_time=1)
+            case "yt":
+                await yt.answer_download(query, text)
+            case "sf":
+                await sf.answer_download(query, text)
+            case _:
                 await query.answer([
                     InlineQueryResultArticle(
-                        id="bad_link",
-                        title="Ссылка не ведет на трек",
-                        description="Не удалось найти track_id",
-                        input_message_content=InputTextMessageContent(message_text="ссылка не ведет на трек"),
+                        id="not_supported",
+                        title="Сервис не поддерживается",
+                        description="Эта ссылка не подходит",
+                        input_message_content=InputTextMessageContent(message_text="сервис не поддерживается"),
                     )
                 ], cache_time=1)
-        elif yt.is_youtube_link(text):
-            await yt.answer_download(query, text)
-        elif sf.is_spotify_link(text):
-            await sf.answer_download(query, text)
-        else:
-            await query.answer([
-                InlineQueryResultArticle(
-                    id="not_supported",
-                    title="Сервис не поддерживается",
-                    description="Эта ссылка не подходит",
-                    input_message_content=InputTextMessageContent(message_text="сервис не поддерживается"),
-                )
-            ], cache_time=1)
+    elif branch == "search":
+        match service:
+            case "ym":
+                await answer_search_ym(query, text[3:])
+            case "yt":
+                await answer_search_yt(query, text[3:])
+            case "sf":
+                await answer_search_sf(query, text[3:])
     else:
-        if text.startswith("ym "):
-            await answer_search_ym(query, text[3:])
-        elif text.startswith("yt "):
-            await answer_search_yt(query, text[3:])
-        elif text.startswith("sf "):
-            await answer_search_sf(query, text[3:])
-        elif text == "":
-            pass
-        else:
-            pref = await get_pref_service(query.from_user.id)
-            match pref:
-                case "ym":
-                    await answer_search_ym(query, text)
-                case "yt":
-                    await answer_search_yt(query, text)
-                case "sf":
-                    await answer_search_sf(query, text)
-                case None:
-                    await query.answer([
-                        InlineQueryResultArticle(
-                            id="unknown",
-                            title="Непонятный запрос",
-                            description="Попробуйте /help в нашем боте",
-                            input_message_content=InputTextMessageContent(message_text="не понимаю запрос"),
-                        )
-                    ], cache_time=1)
-                case _:
-                    await query.answer([
-                        InlineQueryResultArticle(
-                            id="unknown",
-                            title="Выбран неправильный сервис в предпочтительном",
-                            description="Попробуйте /help в нашем боте",
-                            input_message_content=InputTextMessageContent(message_text="не понимаю запрос"),
-                        )
-                    ], cache_time=1)
+        match service:
+            case "ym":
+                await answer_search_ym(query, text)
+            case "yt":
+                await answer_search_yt(query, text)
+            case "sf":
+                await answer_search_sf(query, text)
+            case "none":
+                await query.answer([
+                    InlineQueryResultArticle(
+                        id="unknown",
+                        title="Непонятный запрос",
+                        description="Попробуйте /help в нашем боте",
+                        input_message_content=InputTextMessageContent(message_text="не понимаю запрос"),
+                    )
+                ], cache_time=1)
+            case _:
+                await query.answer([
+                    InlineQueryResultArticle(
+                        id="unknown",
+                        title="Выбран неправильный сервис в предпочтительном",
+                        description="Попробуйте /help в нашем боте",
+                        input_message_content=InputTextMessageContent(message_text="не понимаю запрос"),
+                    )
+                ], cache_time=1)
@@ -0,0 +1,165 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Awaitable, Callable, Optional
+
+from aiogram import Bot
+from redis.exceptions import ResponseError
+
+import storage
+from metrics import IN_FLIGHT
+from tracing import current_request_id, span, trace_request
+
+# 1 — бот только ставит загрузки в очередь, качают процессы worker.py
+DOWNLOAD_QUEUE = os.getenv("DOWNLOAD_QUEUE", "0") == "1"
+JOB_TIMEOUT = int(os.getenv("JOB_TIMEOUT", "600"))
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "4"))
+# задача упавшего воркера забирается другим через JOB_CLAIM_IDLE секунд;
+# живой воркер раз в JOB_HEARTBEAT секунд подтверждает, что задача ещё у него
+JOB_CLAIM_IDLE = int(os.getenv("JOB_CLAIM_IDLE", "60"))
+JOB_HEARTBEAT = JOB_CLAIM_IDLE / 4
+STREAM = "jobs:download"
+GROUP = "workers"
+RESULT_TTL = 300
+
+logger = logging.getLogger(__name__)
+
+JobHandler = Callable[[Bot, dict], Awaitable[str]]
+_handlers: dict[str, JobHandler] = {}
+
+
+class JobError(Exception):
+    """busy — временная перегрузка (очередь yt-dlp, диск): стоит повторить позже."""
+
+    def __init__(self, message: str, busy: bool = False):
+        super().__init__(message)
+        self.busy = busy
+
+
+def register(kind: str, handler: JobHandler) -> None:
+    """handler(bot, payload) скачивает, загружает в Telegram и возвращает file_id."""
+    _handlers[kind] = handler
+
+
+async def run(kind: str, payload: dict, bot: Bot) -> str:
+    """
+    Выполняет загрузку: локально или через очередь воркеров,
+    если включён DOWNLOAD_QUEUE. Возвращает file_id.
+    """
+    with IN_FLIGHT.labels(f"jobs_{kind}").track_inprogress(), span(f"job.{kind}"):
+        if DOWNLOAD_QUEUE and storage.redis_client is not None:
+            return await _submit(kind, payload)
+        try:
+            return await _handlers[kind](bot, payload)
+        except Exception as e:
+            # как и в режиме очереди, вызывающий получает JobError
+            raise JobError(str(e) or type(e).__name__, busy=getattr(e, "busy", False)) from e
+
+
+async def _submit(kind: str, payload: dict) -> str:
+    redis = storage.redis_client
+    job_id = uuid.uuid4().hex
+    fields = {"id": job_id, "kind": kind, "payload": json.dumps(payload)}
+    request_id = current_request_id()
+    if request_id:
+        # воркер продолжает трейс под тем же request_id
+        fields["trace"] = request_id
+    await redis.xadd(STREAM, fields)
+    reply = await redis.blpop([f"jobs:result:{job_id}"], timeout=JOB_TIMEOUT)
+    if reply is None:
+        raise JobError(f"job {kind}:{job_id} timed out")
+    result = json.loads(reply[1])
+    if not result.get("ok"):
+        raise JobError(result.get("error") or "job failed", busy=result.get("busy", False))
+    return result["file_id"]
+
+
+# ─── Воркер ───
+
+async def _heartbeat(consumer: str, message_id: str) -> None:
+    """Сбрасывает idle записи в PEL, чтобы XAUTOCLAIM не отдал её другому воркеру."""
+    while True:
+        await asyncio.sleep(JOB_HEARTBEAT)
+        try:
+            await storage.redis_client.xclaim(
+                STREAM, GROUP, consumer, min_idle_time=0, message_ids=[message_id], justid=True
+            )
+        except Exception:
+            logger.warning("heartbeat for job %s failed", message_id, exc_info=True)
+
+
+def _expired(message_id: str) -> bool:
+    # id записи начинается с времени XADD в мс; бот ждёт ответа не дольше JOB_TIMEOUT
+    enqueued_ms = int(message_id.split("-", 1)[0])
+    return time.time() * 1000 - enqueued_ms > JOB_TIMEOUT * 1000
+
+
+async def _execute(bot: Bot, consumer: str, message_id: str, fields: dict) -> None:
+    redis = storage.redis_client
+    job_id = fields.get("id", message_id)
+    kind = fields.get("kind")
+    heartbeat = asyncio.create_task(_heartbeat(consumer, message_id))
+    try:
+        if _expired(message_id):
+            raise JobError("expired: nobody waits for the result")
+        handler = _handlers[kind]
+        with trace_request(f"job.{kind}", request_id=fields.get("trace"), job_id=job_id):
+            file_id = await handler(bot, json.loads(fields["payload"]))
+        result = {"ok": True, "file_id": file_id}
+    except Exception as e:
+        logger.exception("job %s:%s failed", kind, job_id)
+        result = {"ok": False, "error": str(e) or type(e).__name__, "busy": getattr(e, "busy", False)}
+    finally:
+        heartbeat.cancel()
+    reply_key = f"jobs:result:{job_id}"
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.rpush(reply_key, json.dumps(result))
+        pipe.expire(reply_key, RESULT_TTL)
+        pipe.xack(STREAM, GROUP, message_id)
+        pipe.xdel(STREAM, message_id)
+        await pipe.execute()
+
+
+async def run_worker(bot: Bot, consumer: Optional[str] = None) -> None:
+    """
+    Читает задачи из Redis Stream группой GROUP. Воркеров можно запускать
+    сколько угодно: каждая задача достаётся одному из них. Пока задача
+    выполняется, воркер продлевает её heartbeat-ом; задачи упавшего воркера
+    забираются через XAUTOCLAIM после JOB_CLAIM_IDLE, пока бот ещё ждёт.
+    """
+    redis = storage.redis_client
+    consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+    try:
+        await redis.xgroup_create(STREAM, GROUP, id="0", mkstream=True)
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+    slots = asyncio.Semaphore(WORKER_CONCURRENCY)
+    tasks: set[asyncio.Task] = set()
+
+    def _spawn(message_id: str, fields: dict):
+        task = asyncio.create_task(_execute(bot, consumer, message_id, fields))
+        tasks.add(task)
+        task.add_done_callback(lambda t: (tasks.discard(t), slots.release()))
+
+    logger.info("worker %s started, concurrency %d", consumer, WORKER_CONCURRENCY)
+    while True:
+        await slots.acquire()
+        reply = await redis.xautoclaim(
+            STREAM, GROUP, consumer, min_idle_time=JOB_CLAIM_IDLE * 1000, count=1
+        )
+        claimed = [(message_id, fields) for message_id, fields in reply[1] if fields]
+        if claimed:
+            _spawn(*claimed[0])
+            continue
+        batch = await redis.xreadgroup(GROUP, consumer, {STREAM: ">"}, count=1, block=5000)
+        if not batch:
+            slots.release()
+            continue
+        for _, messages in batch:
+            for message_id, fields in messages:
+                _spawn(message_id, fields)
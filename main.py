@@ -1,13 +1,25 @@
 import asyncio
 import logging
+import multiprocessing
 import os
+import signal
+from typing import Optional
 
 import redis.asyncio as aioredis
+from aiohttp import web
 from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.types import BotCommand
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from dotenv import load_dotenv
 
-from storage import set_redis_client
+from storage import set_redis_client, init_db, close_db, watch_settings
+from httpClient import init_http_session, close_http_session
+from workspace import run_janitor
+from telegramScheduler import TelegramScheduler
+from metrics import METRICS_PORT, monitor_loop_lag, start_metrics_server
+from tracing import RequestIdFilter, TracingMiddleware, setup_tracing, shutdown_tracing
 from commandsModule import router as commands_router
 from inlineModule import router as inline_router
 from yandexModule import router as yandex_router
@@ -17,29 +29,167 @@ from spotifyModule import router as spotify_router
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# локальный Bot API server или заглушка Telegram для тестов
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
 
-async def main():
-    logging.basicConfig(level=logging.INFO,
-                        format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
-    redis_client = aioredis.from_url(REDIS_URL, encoding="utf-8", decode_responses=True)
-    set_redis_client(redis_client)
+# polling | webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("WEB_PORT", "8080"))
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1"))
+
+COMMANDS = [
+    BotCommand(command="start", description="Начать"),
+    BotCommand(command="help", description="Помощь"),
+    BotCommand(command="token", description="Добавить токен"),
+    BotCommand(command="cookie", description="Добавить cookies"),
+]
 
-    bot = Bot(BOT_TOKEN)
+
+def create_bot() -> Bot:
+    session = AiohttpSession()
+    if TELEGRAM_API_URL:
+        session.api = TelegramAPIServer.from_base(TELEGRAM_API_URL)
+    bot = Bot(BOT_TOKEN, session=session)
+    bot.session.middleware(TelegramScheduler())
+    return bot
+
+
+def create_dispatcher() -> Dispatcher:
     dp = Dispatcher()
+    dp.update.outer_middleware(TracingMiddleware())
     dp.include_router(commands_router)
     dp.include_router(inline_router)
     dp.include_router(yandex_router)
     dp.include_router(spotify_router)
     dp.include_router(youtube_router)
+    return dp
+
+
+def setup_logging():
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s [%(levelname)s] %(name)s [%(request_id)s]: %(message)s")
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(RequestIdFilter())
+
+
+_background: list[asyncio.Task] = []
+_metrics_runner: Optional[web.AppRunner] = None
+
+
+async def start_services(metrics_port: int = METRICS_PORT):
+    global _metrics_runner
+    redis_client = aioredis.from_url(REDIS_URL, encoding="utf-8", decode_responses=True)
+    set_redis_client(redis_client)
+    await init_db()
+    await init_http_session()
+    setup_tracing()
+    _metrics_runner = await start_metrics_server(metrics_port)
+    _background.append(asyncio.create_task(run_janitor()))
+    _background.append(asyncio.create_task(monitor_loop_lag()))
+    _background.append(asyncio.create_task(watch_settings()))
+
+
+async def stop_services():
+    for task in _background:
+        task.cancel()
+    _background.clear()
+    if _metrics_runner is not None:
+        await _metrics_runner.cleanup()
+    await close_db()
+    await close_http_session()
+    await asyncio.to_thread(shutdown_tracing)
+
+
+def create_webhook_app(dp: Dispatcher, bot: Bot) -> web.Application:
+    """aiohttp-приложение с обработчиком вебхука; Telegram шлёт X-Telegram-Bot-Api-Secret-Token."""
+    app = web.Application()
+    SimpleRequestHandler(dp, bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def serve_webhook(index: int = 0):
+    """
+    Один процесс вебхук-сервера. Несколько таких процессов делят порт через SO_REUSEPORT,
+    а /metrics каждый отдаёт на своём порту METRICS_PORT + index.
+    """
+    await start_services(METRICS_PORT + index if METRICS_PORT else 0)
+    bot = create_bot()
+    dp = create_dispatcher()
+    runner = web.AppRunner(create_webhook_app(dp, bot))
+    await runner.setup()
+    site = web.TCPSite(runner, WEB_HOST, WEB_PORT, reuse_port=WEB_WORKERS > 1)
+    await site.start()
+    logging.getLogger(__name__).info("webhook worker %d listening on %s:%d", os.getpid(), WEB_HOST, WEB_PORT)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await stop_services()
+
+
+def _run_webhook_worker(index: int):
+    setup_logging()
+    asyncio.run(serve_webhook(index))
+
+
+async def register_webhook():
+    bot = create_bot()
+    try:
+        await bot.set_my_commands(COMMANDS)
+        await bot.set_webhook(
+            f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            drop_pending_updates=False,
+        )
+    finally:
+        await bot.session.close()
+
+
+def run_webhook():
+    if not WEBHOOK_SECRET:
+        # без секрета публичный эндпоинт принимает поддельные апдейты от кого угодно
+        raise SystemExit("BOT_MODE=webhook requires WEBHOOK_SECRET")
+    asyncio.run(register_webhook())
+    if WEB_WORKERS <= 1:
+        asyncio.run(serve_webhook())
+        return
+    ctx = multiprocessing.get_context("spawn")
+    workers = [ctx.Process(target=_run_webhook_worker, args=(i,)) for i in range(WEB_WORKERS)]
+    for process in workers:
+        process.start()
+
+    def _stop(signum, frame):
+        # SIGTERM приходит только родителю; без этого воркеры остаются сиротами
+        for process in workers:
+            process.terminate()
+
+    signal.signal(signal.SIGTERM, _stop)
+    for process in workers:
+        process.join()
+
+
+async def main():
+    await start_services()
+
+    bot = create_bot()
+    dp = create_dispatcher()
 
-    await bot.set_my_commands([
-        BotCommand(command="start", description="Начать"),
-        BotCommand(command="help", description="Помощь"),
-        BotCommand(command="token", description="Добавить токен"),
-        BotCommand(command="cookie", description="Добавить cookies"),
-    ])
+    await bot.set_my_commands(COMMANDS)
 
-    await dp.start_polling(bot)
+    try:
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
+    finally:
+        await stop_services()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    setup_logging()
+    if BOT_MODE == "webhook":
+        run_webhook()
+    else:
+        asyncio.run(main())
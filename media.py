@@ -0,0 +1,29 @@
+import os
+
+import aiohttp
+from aiogram.types import BufferedInputFile, InputFile, URLInputFile
+
+from httpClient import get_session
+
+# файлы до этого размера держим целиком в памяти, крупнее — стримим в Telegram
+MEDIA_MEMORY_LIMIT = int(os.getenv("MEDIA_MEMORY_LIMIT", str(20 * 1024 * 1024)))
+MEDIA_FETCH_TIMEOUT = int(os.getenv("MEDIA_FETCH_TIMEOUT", "120"))
+
+
+async def remote_input_file(url: str, filename: str, size_hint: int = 0) -> InputFile:
+    """
+    InputFile для загрузки медиа по прямой ссылке без записи на диск.
+
+    Небольшие файлы скачиваются в память (BufferedInputFile): их можно
+    переотправить, если Telegram попросит подождать. Большие отдаются
+    URLInputFile — aiogram начинает upload, пока байты ещё приходят.
+    """
+    if size_hint > MEDIA_MEMORY_LIMIT:
+        return URLInputFile(url, filename=filename, timeout=MEDIA_FETCH_TIMEOUT)
+    session = await get_session()
+    async with session.get(url, timeout=aiohttp.ClientTimeout(total=MEDIA_FETCH_TIMEOUT)) as r:
+        r.raise_for_status()
+        if r.content_length and r.content_length > MEDIA_MEMORY_LIMIT:
+            return URLInputFile(url, filename=filename, timeout=MEDIA_FETCH_TIMEOUT)
+        data = await r.read()
+    return BufferedInputFile(data, filename=filename)
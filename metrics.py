@@ -0,0 +1,89 @@
+import asyncio
+import os
+from typing import Optional
+
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# 0 — не поднимать /metrics
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+# у worker.py свой порт, вне диапазона METRICS_PORT + номер вебхук-воркера
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9200"))
+LOOP_LAG_INTERVAL = 0.5
+
+INLINE_LATENCY = Histogram(
+    "bot_inline_query_seconds",
+    "Время обработки инлайн-запроса; status — ok, error или cancelled",
+    ["service", "branch", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+CACHE_REQUESTS = Counter(
+    "bot_cache_requests",
+    "Обращения к кэшам",
+    ["cache", "result"],
+)
+TRANSFER_SECONDS = Histogram(
+    "bot_media_transfer_seconds",
+    "Длительность скачивания и загрузки медиа в Telegram",
+    ["service", "stage"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+MEDIA_BYTES = Histogram(
+    "bot_media_bytes",
+    "Размер загруженных в Telegram файлов",
+    ["service"],
+    buckets=tuple(2 ** i * 1024 * 1024 for i in range(-2, 7)),
+)
+LOOP_LAG = Histogram(
+    "bot_event_loop_lag_seconds",
+    "Задержка event loop относительно запланированного пробуждения",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+IN_FLIGHT = Gauge(
+    "bot_in_flight",
+    "Выполняющиеся и ожидающие задачи",
+    ["kind"],
+)
+
+
+def cache_result(cache: str, hit: bool) -> None:
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def register_collectors() -> None:
+    """Гейджи, читающие состояние очередей в момент скрейпа."""
+    import inlineModule
+    import yandexApi
+    import ytdlpWorker
+
+    IN_FLIGHT.labels("inline").set_function(lambda: len(inlineModule._inflight))
+    IN_FLIGHT.labels("ym_api_waiting").set_function(lambda: yandexApi.stats()["waiting"])
+    IN_FLIGHT.labels("ym_api_running").set_function(lambda: yandexApi.stats()["running"])
+    IN_FLIGHT.labels("yt_waiting").set_function(lambda: ytdlpWorker.stats()["waiting"])
+    IN_FLIGHT.labels("yt_running").set_function(lambda: ytdlpWorker.stats()["running"])
+    IN_FLIGHT.labels("yt_prefetching").set_function(lambda: ytdlpWorker.stats()["prefetching"])
+
+
+async def monitor_loop_lag() -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        LOOP_LAG.observe(max(loop.time() - started - LOOP_LAG_INTERVAL, 0.0))
+
+
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
+async def start_metrics_server(port: int = METRICS_PORT) -> Optional[web.AppRunner]:
+    """Отдельный aiohttp-сервер с /metrics; у каждого процесса свой порт."""
+    if not port:
+        return None
+    register_collectors()
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+    return runner
@@ -0,0 +1,95 @@
+import asyncio
+import contextlib
+import logging
+import os
+from typing import Awaitable, Callable, Optional
+
+from telegramScheduler import low_priority
+
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", "3"))
+
+logger = logging.getLogger(__name__)
+
+
+def _size(num: Optional[float]) -> str:
+    num = num or 0
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if num < 1024 or unit == "GiB":
+            return f"{num:.1f} {unit}" if unit != "B" else f"{int(num)} {unit}"
+        num /= 1024
+    return ""
+
+
+def format_progress(event: dict) -> str:
+    """Текст статуса для события из ytdlpWorker (hook yt-dlp или очередь)."""
+    status = event.get("status")
+    if status == "queued":
+        return f"В очереди на загрузку: {event.get('position')}"
+    if status == "downloading":
+        downloaded, total = event.get("downloaded"), event.get("total")
+        parts = []
+        if total:
+            # total_bytes_estimate у yt-dlp — float
+            parts.append(f"{int(downloaded * 100 // total)}%")
+        else:
+            parts.append(_size(downloaded))
+        if event.get("speed"):
+            parts.append(f"{_size(event['speed'])}/s")
+        if event.get("eta") is not None:
+            minutes, seconds = divmod(int(event["eta"]), 60)
+            parts.append(f"осталось {minutes}:{seconds:02d}")
+        return "Скачиваю: " + " · ".join(parts)
+    if status in ("finished", "processing"):
+        return "Обрабатываю…"
+    return "Скачиваю…"
+
+
+class ProgressReporter:
+    """
+    Сводит поток обновлений в редкие правки одного сообщения:
+    не чаще раза в interval, промежуточные состояния отбрасываются,
+    последнее состояние отправляется всегда (close).
+    """
+
+    def __init__(self, send: Callable[[str], Awaitable], interval: float = PROGRESS_INTERVAL):
+        self._send = send
+        self._interval = interval
+        self._pending: Optional[str] = None
+        self._sent: Optional[str] = None
+        self._last_sent = float("-inf")
+        self._task: Optional[asyncio.Task] = None
+
+    def update(self, text: str) -> None:
+        self._pending = text
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        delay = self._last_sent + self._interval - asyncio.get_running_loop().time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self._flush()
+
+    async def _flush(self, final: bool = False):
+        text, self._pending = self._pending, None
+        if text is None or text == self._sent:
+            return
+        self._last_sent = asyncio.get_running_loop().time()
+        try:
+            if final:
+                await self._send(text)
+            else:
+                with low_priority():
+                    await self._send(text)
+            self._sent = text
+        except Exception as e:
+            logger.warning("progress update failed: %s", e)
+
+    async def close(self, final: Optional[str] = None):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+        if final is not None:
+            self._pending = final
+        await self._flush(final=True)
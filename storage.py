@@ -1,36 +1,176 @@
 import os
 import json
+import time
+import uuid
+import asyncio
+import hashlib
+import logging
+import unicodedata
+from collections import OrderedDict
 from contextlib import asynccontextmanager
-from typing import Optional
+from typing import Awaitable, Callable, List, Optional
 
 import aiosqlite
 import redis.asyncio as aioredis
 
+from metrics import cache_result
+from tracing import traced
+
 DB_DIR = os.getenv("DB_DIR", "/app/db")
 os.makedirs(DB_DIR, exist_ok=True)
 DB_PATH = os.path.join(DB_DIR, "users.db")
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "600"))
+SINGLEFLIGHT_LOCK_TTL = int(os.getenv("SINGLEFLIGHT_LOCK_TTL", "600"))
+SINGLEFLIGHT_RESULT_TTL = 120
+SINGLEFLIGHT_POLL = 0.5
+SETTINGS_CACHE_SIZE = int(os.getenv("SETTINGS_CACHE_SIZE", "10000"))
+SETTINGS_CACHE_TTL = float(os.getenv("SETTINGS_CACHE_TTL", "300"))
+YM_INFO_TTL = 24 * 3600
+YT_INFO_TTL = int(os.getenv("YT_INFO_TTL", "86400"))
+YT_INFO_LOCAL_SIZE = int(os.getenv("YT_INFO_LOCAL_SIZE", "1024"))
+# результаты extract_info из yt-dlp: словари большие, держим немного и недолго
+YT_EXTRACT_CACHE_SIZE = int(os.getenv("YT_EXTRACT_CACHE_SIZE", "64"))
+YT_EXTRACT_TTL = int(os.getenv("YT_EXTRACT_TTL", "1800"))
 
 redis_client: aioredis.Redis | None = None
+logger = logging.getLogger(__name__)
+
+
+class LocalCache:
+    """LRU в памяти процесса с ограничением по размеру и TTL записей."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[object, tuple[float, object]]" = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        if time.monotonic() - entry[0] >= self.ttl:
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return entry[1]
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic(), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
 
 def set_redis_client(client: aioredis.Redis):
     global redis_client
     redis_client = client
 
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    ym_token TEXT,
+    pref_service TEXT DEFAULT NULL
+);
+"""
+
+_db: aiosqlite.Connection | None = None
+_db_lock = asyncio.Lock()
+
+
+async def init_db():
+    """Открывает общее соединение (WAL) и один раз применяет схему."""
+    global _db
+    async with _db_lock:
+        if _db is not None:
+            return
+        db = await aiosqlite.connect(DB_PATH)
+        await db.execute("PRAGMA journal_mode=WAL")
+        await db.execute("PRAGMA synchronous=NORMAL")
+        await db.executescript(SCHEMA)
+        await db.commit()
+        _db = db
+
+
+async def close_db():
+    global _db
+    if _db is not None:
+        await _db.close()
+        _db = None
+
+
 @asynccontextmanager
 async def with_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.executescript(
-            """
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                ym_token TEXT,
-                pref_service TEXT DEFAULT NULL
-            );
-            """
-        )
-        await db.commit()
-        yield db
+    if _db is None:
+        await init_db()
+    yield _db
+
+
+_MISSING = object()
+# user_id -> (ym_token, pref_service)
+_settings = LocalCache(SETTINGS_CACHE_SIZE, SETTINGS_CACHE_TTL)
+# сюда публикуется user_id при смене настроек: LRU есть в каждом процессе
+SETTINGS_CHANNEL = "settings:invalidate"
+
 
+async def _user_settings(user_id: int) -> tuple[Optional[str], Optional[str]]:
+    """
+    Токен и предпочитаемый сервис одним запросом, дальше из LRU.
+    Другие процессы сбрасывают запись через SETTINGS_CHANNEL (см. watch_settings);
+    пользователь без токена не кэшируется, чтобы добавленный токен работал сразу.
+    """
+    cached = _settings.get(user_id, _MISSING)
+    cache_result("settings", cached is not _MISSING)
+    if cached is not _MISSING:
+        return cached
+    async with with_db() as db:
+        async with db.execute(
+            "SELECT ym_token, pref_service FROM users WHERE user_id = ?",
+            (user_id,),
+        ) as cur:
+            row = await cur.fetchone()
+    settings = tuple(row) if row else (None, None)
+    if settings[0] is not None:
+        _settings.set(user_id, settings)
+    return settings
+
+
+async def _invalidate_settings(user_id: int):
+    _settings.pop(user_id)
+    if redis_client is not None:
+        await redis_client.publish(SETTINGS_CHANNEL, user_id)
+
+
+async def watch_settings():
+    """
+    Фоновая задача процесса: сбрасывает записи LRU настроек по сообщениям
+    из SETTINGS_CHANNEL. После переподключения кэш очищается целиком —
+    сообщения, пришедшие без подписки, потеряны.
+    """
+    delay = 1
+    while True:
+        try:
+            async with redis_client.pubsub() as pubsub:
+                await pubsub.subscribe(SETTINGS_CHANNEL)
+                _settings.clear()
+                delay = 1
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        _settings.pop(int(message["data"]))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("settings invalidation listener failed, retry in %ds: %s", delay, e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+
+
+@traced("storage.save_ym_token")
 async def save_ym_token(user_id: int, token: str):
     async with with_db() as db:
         await db.execute(
@@ -42,16 +182,14 @@ async def save_ym_token(user_id: int, token: str):
             (user_id, token),
         )
         await db.commit()
+    await _invalidate_settings(user_id)
 
+@traced("storage.fetch_ym_token")
 async def fetch_ym_token(user_id: int) -> Optional[str]:
-    async with with_db() as db:
-        async with db.execute(
-            "SELECT ym_token FROM users WHERE user_id = ?",
-            (user_id,),
-        ) as cur:
-            row = await cur.fetchone()
-            return row[0] if row else None
+    ym_token, _ = await _user_settings(user_id)
+    return ym_token
 
+@traced("storage.save_pref_service")
 async def save_pref_service(user_id: int, pref_service: str):
     async with with_db() as db:
         await db.execute(
@@ -63,33 +201,248 @@ async def save_pref_service(user_id: int, pref_service: str):
             (user_id, pref_service),
         )
         await db.commit()
+    await _invalidate_settings(user_id)
 
+@traced("storage.get_pref_service")
 async def get_pref_service(user_id: int):
-    async with with_db() as db:
-        async with db.execute(
-            "SELECT pref_service FROM users WHERE user_id = ?",
-            (user_id,),
-        ) as cur:
-            row = await cur.fetchone()
-            return row[0] if row else None
+    _, pref_service = await _user_settings(user_id)
+    return pref_service
+
+def _ym_info_key(track_id: str) -> str:
+    return f"info_ym:{track_id}"
+
+def _ym_info_fields(page: Optional[int]) -> List[str]:
+    fields = ["title", "artists", "pages"]
+    if page is not None:
+        fields.append(f"page:{page}")
+    return fields
 
-async def cache_get_ym_info(track_id: str) -> Optional[dict]:
+def _parse_ym_info(values: list, page: Optional[int]) -> Optional[dict]:
+    cache_result("ym_info", values[0] is not None)
+    if values[0] is None:
+        return None
+    info = {"title": values[0], "artists": values[1], "page_count": int(values[2] or 0)}
+    if page is not None:
+        info["page"] = values[3]
+    return info
+
+def _queue_ym_info(pipe, track_id: str, title: str, artists: str, pages: List[str]):
+    key = _ym_info_key(track_id)
+    mapping = {"title": title, "artists": artists, "pages": len(pages)}
+    mapping.update({f"page:{i}": page for i, page in enumerate(pages)})
+    # лишние страницы прежней версии не должны пережить перезапись
+    pipe.delete(key)
+    pipe.hset(key, mapping=mapping)
+    pipe.expire(key, YM_INFO_TTL)
+
+@traced("storage.cache_get_ym_info")
+async def cache_get_ym_info(track_id: str, page: Optional[int] = None) -> Optional[dict]:
+    """
+    {'title', 'artists', 'page_count'} из хэша info_ym:{id}; с page ещё и
+    сырой текст этой страницы ('page', None вне диапазона). Один HMGET.
+    """
     if redis_client is None:
         return None
-    data = await redis_client.get(f"track_ym:{track_id}")
+    values = await redis_client.hmget(_ym_info_key(track_id), _ym_info_fields(page))
+    return _parse_ym_info(values, page)
+
+@traced("storage.cache_set_ym_info")
+async def cache_set_ym_info(track_id: str, title: str, artists: str, pages: List[str]):
+    """Метаданные и каждая страница текста — отдельные поля хэша."""
+    if redis_client is None:
+        return
+    async with redis_client.pipeline(transaction=True) as pipe:
+        _queue_ym_info(pipe, track_id, title, artists, pages)
+        await pipe.execute()
+
+@traced("storage.cache_get_ym")
+async def cache_get_ym(track_id: str, page: Optional[int] = None) -> tuple[Optional[str], Optional[dict]]:
+    """file_id и информация о треке (как cache_get_ym_info) за один round trip."""
+    if redis_client is None:
+        return None, None
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.get(f"file_ym:{track_id}")
+        pipe.hmget(_ym_info_key(track_id), _ym_info_fields(page))
+        file_id, values = await pipe.execute()
+    cache_result("ym_file", bool(file_id))
+    return file_id, _parse_ym_info(values, page)
+
+@traced("storage.cache_set_ym")
+async def cache_set_ym(track_id: str, file_id: str, title: str, artists: str, pages: List[str]):
+    """Записывает file_id и информацию о треке одной транзакцией MULTI."""
+    if redis_client is None:
+        return
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.set(f"file_ym:{track_id}", file_id)
+        _queue_ym_info(pipe, track_id, title, artists, pages)
+        await pipe.execute()
+
+
+@traced("storage.cache_file_get_yt")
+async def cache_file_get_yt(video_id: str, fmt: str) -> Optional[dict]:
+    """{'file_id', 'title', 'author'} для уже загруженного ролика в формате fmt."""
+    if redis_client is None:
+        return None
+    data = await redis_client.get(f"file_yt:{video_id}:{fmt}")
+    cache_result("yt_file", bool(data))
     return json.loads(data) if data else None
 
-async def cache_set_ym_info(track_id: str, info: dict):
+@traced("storage.cache_file_set_yt")
+async def cache_file_set_yt(video_id: str, fmt: str, file_id: str, title: str, author: str):
+    if redis_client is None:
+        return
+    await redis_client.set(
+        f"file_yt:{video_id}:{fmt}",
+        json.dumps({"file_id": file_id, "title": title, "author": author}),
+    )
+
+
+_yt_info_local = LocalCache(YT_INFO_LOCAL_SIZE, YT_INFO_TTL)
+
+
+@traced("storage.cache_get_yt_info")
+async def cache_get_yt_info(video_id: str) -> Optional[dict]:
+    """Карточка ролика: сначала LRU процесса, затем общий Redis."""
+    info = _yt_info_local.get(video_id)
+    cache_result("yt_info_local", info is not None)
+    if info is not None or redis_client is None:
+        return info
+    data = await redis_client.get(f"info_yt:{video_id}")
+    cache_result("yt_info", bool(data))
+    if not data:
+        return None
+    info = json.loads(data)
+    _yt_info_local.set(video_id, info)
+    return info
+
+@traced("storage.cache_set_yt_info")
+async def cache_set_yt_info(video_id: str, info: dict):
+    _yt_info_local.set(video_id, info)
     if redis_client is None:
         return
-    await redis_client.setex(f"track_ym:{track_id}", 24 * 3600, json.dumps(info))
+    await redis_client.setex(f"info_yt:{video_id}", YT_INFO_TTL, json.dumps(info))
 
-async def cache_file_get_ym(track_id: str) -> Optional[str]:
+
+_yt_extract_local = LocalCache(YT_EXTRACT_CACHE_SIZE, YT_EXTRACT_TTL)
+
+
+@traced("storage.cache_get_yt_extract")
+async def cache_get_yt_extract(video_id: str) -> Optional[dict]:
+    """
+    Результат экстракции yt-dlp: LRU процесса, затем Redis —
+    воркеры из worker.py берут его оттуда, не повторяя экстракцию.
+    """
+    extracted = _yt_extract_local.get(video_id)
+    cache_result("yt_extract_local", extracted is not None)
+    if extracted is not None or redis_client is None:
+        return extracted
+    data = await redis_client.get(f"extract_yt:{video_id}")
+    cache_result("yt_extract", bool(data))
+    if not data:
+        return None
+    extracted = json.loads(data)
+    _yt_extract_local.set(video_id, extracted)
+    return extracted
+
+@traced("storage.cache_set_yt_extract")
+async def cache_set_yt_extract(video_id: str, extracted: dict):
+    _yt_extract_local.set(video_id, extracted)
+    if redis_client is None:
+        return
+    await redis_client.setex(f"extract_yt:{video_id}", YT_EXTRACT_TTL, json.dumps(extracted))
+
+
+def normalize_query(query: str) -> str:
+    """Регистр, пробелы и юникод-формы не должны плодить разные ключи кэша."""
+    folded = unicodedata.normalize("NFKC", query).casefold()
+    return " ".join(folded.split())
+
+
+def _search_key(service: str, query: str) -> str:
+    digest = hashlib.sha1(normalize_query(query).encode()).hexdigest()
+    return f"search:{service}:{digest}"
+
+
+@traced("storage.cache_get_search")
+async def cache_get_search(service: str, query: str) -> Optional[list]:
     if redis_client is None:
         return None
-    return await redis_client.get(f"file_ym:{track_id}")
+    data = await redis_client.get(_search_key(service, query))
+    cache_result(f"search_{service}", bool(data))
+    return json.loads(data) if data else None
+
 
-async def cache_file_set_ym(track_id: str, file_id: str):
+@traced("storage.cache_set_search")
+async def cache_set_search(service: str, query: str, results: list):
     if redis_client is None:
         return
-    await redis_client.set(f"file_ym:{track_id}", file_id)
+    await redis_client.setex(
+        _search_key(service, query),
+        SEARCH_CACHE_TTL,
+        json.dumps(results, ensure_ascii=False, separators=(",", ":")),
+    )
+
+
+# ─── singleflight: одна загрузка на ключ, остальные ждут результат ───
+_RELEASE_LOCK = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+_local_flights: dict[str, asyncio.Future] = {}
+
+
+async def singleflight(key: str, produce: Callable[[], Awaitable[str]], *,
+                       timeout: float = SINGLEFLIGHT_LOCK_TTL) -> str:
+    """
+    Выполняет produce() один раз на key, даже если его одновременно
+    запросили несколько обработчиков или несколько процессов бота.
+    Внутри процесса ведомые ждут общий Future, между процессами —
+    Redis-лок и ключ с результатом (обычно file_id).
+    """
+    running = _local_flights.get(key)
+    if running is not None:
+        return await asyncio.shield(running)
+    future = asyncio.get_running_loop().create_future()
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    _local_flights[key] = future
+    try:
+        result = await _redis_flight(key, produce, timeout)
+    except asyncio.CancelledError:
+        future.set_exception(RuntimeError(f"singleflight {key} cancelled"))
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        del _local_flights[key]
+
+
+async def _redis_flight(key: str, produce: Callable[[], Awaitable[str]], timeout: float) -> str:
+    if redis_client is None:
+        return await produce()
+    lock_key = f"sf:{key}:lock"
+    result_key = f"sf:{key}:result"
+    owner = uuid.uuid4().hex
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        result = await redis_client.get(result_key)
+        if result:
+            return result
+        if await redis_client.set(lock_key, owner, nx=True, ex=SINGLEFLIGHT_LOCK_TTL):
+            try:
+                result = await produce()
+                await redis_client.setex(result_key, SINGLEFLIGHT_RESULT_TTL, result)
+                return result
+            finally:
+                # лидер упал — лок снят без результата, и лидером станет следующий
+                await redis_client.eval(_RELEASE_LOCK, 1, lock_key, owner)
+        if loop.time() >= deadline:
+            raise asyncio.TimeoutError(f"singleflight {key} timed out")
+        await asyncio.sleep(SINGLEFLIGHT_POLL)
@@ -0,0 +1,131 @@
+import asyncio
+import contextlib
+import contextvars
+import logging
+import os
+import time
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import AnswerCallbackQuery, AnswerInlineQuery, TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+
+from storage import LocalCache
+from tracing import span
+
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))
+TG_CHAT_BURST = float(os.getenv("TG_CHAT_BURST", "3"))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "3"))
+# доля глобального бакета, недоступная низкоприоритетным запросам
+LOW_PRIORITY_RESERVE = 0.3
+
+logger = logging.getLogger(__name__)
+
+_low_priority: contextvars.ContextVar[bool] = contextvars.ContextVar("tg_low_priority", default=False)
+
+# ответы на инлайн-запросы и колбэки не ограничиваются и не ждут
+_UNTHROTTLED = (AnswerInlineQuery, AnswerCallbackQuery)
+
+
+@contextlib.contextmanager
+def low_priority():
+    """Запросы внутри блока (правки прогресса) пропускают вперёд финальные правки."""
+    token = _low_priority.set(True)
+    try:
+        yield
+    finally:
+        _low_priority.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float, reserve: float = 0.0) -> float:
+        """Сколько ждать, пока в бакете будет токен сверх reserve."""
+        self._refill(now)
+        wait = max(self.blocked_until - now, 0.0)
+        missing = 1 + reserve - self.tokens
+        if missing > 0:
+            wait = max(wait, missing / self.rate)
+        return wait
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class TelegramScheduler(BaseRequestMiddleware):
+    """
+    Общий планировщик исходящих запросов бота (request middleware aiogram).
+    Глобальный token bucket плюс бакет на чат / инлайн-сообщение,
+    повтор после TelegramRetryAfter. Правки прогресса (low_priority) не
+    могут занять резерв глобального бакета и не повторяются после 429.
+    """
+
+    def __init__(self):
+        self._global = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+        self._chats = LocalCache(maxsize=10000, ttl=600)
+
+    def _chat_bucket(self, method: TelegramMethod):
+        key = getattr(method, "chat_id", None) or getattr(method, "inline_message_id", None)
+        if key is None:
+            return None
+        bucket = self._chats.get(key)
+        if bucket is None:
+            bucket = TokenBucket(TG_CHAT_RATE, TG_CHAT_BURST)
+            self._chats.set(key, bucket)
+        return bucket
+
+    async def _acquire(self, chat_bucket, low: bool):
+        reserve = self._global.capacity * LOW_PRIORITY_RESERVE if low else 0.0
+        while True:
+            now = time.monotonic()
+            wait = self._global.delay(now, reserve)
+            if chat_bucket is not None:
+                wait = max(wait, chat_bucket.delay(now))
+            if wait <= 0:
+                self._global.take()
+                if chat_bucket is not None:
+                    chat_bucket.take()
+                return
+            await asyncio.sleep(wait)
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        with span(f"tg.{type(method).__name__}"):
+            return await self._send(make_request, bot, method)
+
+    async def _send(self, make_request, bot: Bot, method: TelegramMethod[TelegramType]) -> Response[TelegramType]:
+        if isinstance(method, _UNTHROTTLED):
+            return await make_request(bot, method)
+        low = _low_priority.get()
+        chat_bucket = self._chat_bucket(method)
+        attempt = 0
+        while True:
+            await self._acquire(chat_bucket, low)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                attempt += 1
+                target = chat_bucket if chat_bucket is not None else self._global
+                target.block(e.retry_after)
+                if low or attempt > TG_MAX_RETRIES:
+                    raise
+                logger.warning("%s: flood control, retry in %ss", type(method).__name__, e.retry_after)
@@ -0,0 +1,167 @@
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import os
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+# запросы дольше порога попадают в лог вместе со всеми спанами
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "1000"))
+# OTLP/HTTP коллектор, например http://localhost:4318; пусто — без экспорта
+OTEL_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "")
+OTEL_SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "music-bot")
+MAX_SPANS = 256
+
+logger = logging.getLogger(__name__)
+F = TypeVar("F", bound=Callable[..., Awaitable[Any]])
+
+
+class Trace:
+    """Один входящий апдейт или задача воркера: request_id и плоский список спанов."""
+
+    __slots__ = ("request_id", "name", "attrs", "started", "spans")
+
+    def __init__(self, name: str, request_id: Optional[str] = None, **attrs):
+        self.request_id = request_id or uuid.uuid4().hex[:16]
+        self.name = name
+        self.attrs = attrs
+        self.started = time.perf_counter()
+        # (имя, начало от старта запроса, длительность, ошибка)
+        self.spans: list[tuple[str, float, float, Optional[str]]] = []
+
+
+_current: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("trace", default=None)
+_tracer = None
+_provider = None
+
+
+def current_request_id() -> Optional[str]:
+    trace = _current.get()
+    return trace.request_id if trace is not None else None
+
+
+def _otel_span(name: str, attrs: dict):
+    if _tracer is None:
+        return contextlib.nullcontext()
+    return _tracer.start_as_current_span(
+        name, attributes={k: v for k, v in attrs.items() if isinstance(v, (str, int, float, bool))}
+    )
+
+
+@contextlib.contextmanager
+def span(name: str, **attrs):
+    """
+    Замеряет вызов внутри текущего запроса. Вне запроса только
+    пробрасывает спан в OpenTelemetry, если он включён.
+    """
+    trace = _current.get()
+    started = time.perf_counter()
+    error = None
+    with _otel_span(name, attrs):
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            if trace is not None and len(trace.spans) < MAX_SPANS:
+                finished = time.perf_counter()
+                trace.spans.append((name, started - trace.started, finished - started, error))
+
+
+def traced(name: str) -> Callable[[F], F]:
+    """Декоратор корутины: span(name) вокруг каждого вызова."""
+    def decorator(fn: F) -> F:
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextlib.contextmanager
+def trace_request(name: str, request_id: Optional[str] = None, **attrs):
+    trace = Trace(name, request_id, **attrs)
+    token = _current.set(trace)
+    error = None
+    try:
+        with _otel_span(name, dict(attrs, request_id=trace.request_id)):
+            yield trace
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        _log_if_slow(trace, time.perf_counter() - trace.started, error)
+        _current.reset(token)
+
+
+def _log_if_slow(trace: Trace, duration: float, error: Optional[str]) -> None:
+    if duration * 1000 < SLOW_REQUEST_MS:
+        return
+    record = {
+        "request_id": trace.request_id,
+        "name": trace.name,
+        "duration_ms": round(duration * 1000, 1),
+        **trace.attrs,
+        "spans": [
+            {"name": name, "start_ms": round(start * 1000, 1), "duration_ms": round(took * 1000, 1),
+             **({"error": err} if err else {})}
+            for name, start, took, err in sorted(trace.spans, key=lambda s: s[1])
+        ],
+    }
+    if error:
+        record["error"] = error
+    logger.warning("slow request %s", json.dumps(record, ensure_ascii=False))
+
+
+class RequestIdFilter(logging.Filter):
+    """Добавляет %(request_id)s в записи логов."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = current_request_id() or "-"
+        return True
+
+
+class TracingMiddleware(BaseMiddleware):
+    """Outer-middleware на update: каждый апдейт обрабатывается в своём Trace."""
+
+    async def __call__(self, handler, event: Update, data: dict):
+        user = data.get("event_from_user")
+        with trace_request(event.event_type, update_id=event.update_id,
+                           user_id=user.id if user else None):
+            return await handler(event, data)
+
+
+def setup_tracing() -> None:
+    """Включает экспорт в OpenTelemetry, если задан коллектор и пакет установлен."""
+    global _tracer, _provider
+    if not OTEL_ENDPOINT or _tracer is not None:
+        return
+    try:
+        from opentelemetry import trace as otel_trace
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError:
+        logger.warning("OTEL_EXPORTER_OTLP_ENDPOINT is set, but opentelemetry-sdk is not installed")
+        return
+    # эндпоинт экспортер берёт из OTEL_EXPORTER_OTLP_ENDPOINT и дописывает /v1/traces
+    _provider = TracerProvider(resource=Resource.create({"service.name": OTEL_SERVICE_NAME}))
+    _provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    otel_trace.set_tracer_provider(_provider)
+    _tracer = otel_trace.get_tracer(__name__)
+
+
+def shutdown_tracing() -> None:
+    global _tracer, _provider
+    if _provider is not None:
+        _provider.shutdown()
+    _tracer = _provider = None
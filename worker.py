@@ -0,0 +1,20 @@
+import asyncio
+
+import jobs
+from metrics import WORKER_METRICS_PORT
+from main import create_bot, setup_logging, start_services, stop_services
+
+
+async def main():
+    await start_services(WORKER_METRICS_PORT)
+    # импорт main регистрирует обработчики задач "ym" и "yt"
+    bot = create_bot()
+    try:
+        await jobs.run_worker(bot)
+    finally:
+        await stop_services()
+        await bot.session.close()
+
+if __name__ == "__main__":
+    setup_logging()
+    asyncio.run(main())
@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager
+
+MEDIA_DIR = os.getenv("MEDIA_DIR", "/tmp/inlinebot")
+MEDIA_DISK_LIMIT = int(os.getenv("MEDIA_DISK_LIMIT", str(2 * 1024 ** 3)))
+# каталог старше этого удаляется, даже если pid владельца жив (pid мог достаться другому процессу)
+MEDIA_MAX_AGE = int(os.getenv("MEDIA_MAX_AGE", str(24 * 3600)))
+JANITOR_INTERVAL = int(os.getenv("JANITOR_INTERVAL", "60"))
+
+logger = logging.getLogger(__name__)
+
+HOSTNAME = socket.gethostname()
+
+# каталоги задач этого процесса, которые ещё в работе; sweep идёт в потоке
+_active: set[str] = set()
+_active_lock = threading.Lock()
+
+
+class DiskFull(Exception):
+    """MEDIA_DIR заполнен до MEDIA_DISK_LIMIT: задачу стоит повторить позже."""
+    busy = True
+
+
+@asynccontextmanager
+async def job_workspace(prefix: str = "job"):
+    """
+    Отдельный каталог на задачу: параллельные загрузки одного ролика
+    не перезаписывают файлы друг друга. Удаляется при успехе, ошибке и отмене.
+    Имя содержит pid и хост, чтобы уборщик отличал каталоги упавших процессов
+    и не трогал каталоги других машин и контейнеров с общим MEDIA_DIR.
+    Пока MEDIA_DIR занимает MEDIA_DISK_LIMIT и больше, новые задачи получают DiskFull:
+    каталоги живых задач уборщик не удаляет, поэтому лимит держится на входе.
+    """
+    used = await asyncio.to_thread(disk_usage)
+    if used >= MEDIA_DISK_LIMIT:
+        raise DiskFull(f"media dir holds {used} bytes, MEDIA_DISK_LIMIT is {MEDIA_DISK_LIMIT}")
+    path = os.path.join(MEDIA_DIR, f"{prefix}-{uuid.uuid4().hex}.{os.getpid()}.{HOSTNAME}")
+    # регистрируем до создания: sweep не должен увидеть каталог неактивным
+    with _active_lock:
+        _active.add(path)
+    try:
+        os.makedirs(path)
+        yield path
+    finally:
+        with _active_lock:
+            _active.discard(path)
+        await asyncio.to_thread(shutil.rmtree, path, True)
+
+
+def _owner_alive(name: str) -> bool:
+    """
+    Жив ли процесс, создавший каталог. Каталоги этого процесса вне _active
+    (в т.ч. от прежнего запуска с тем же pid) считаются брошенными; о чужих
+    хостах судить нельзя — их убирает только MEDIA_MAX_AGE.
+    """
+    parts = name.split(".", 2)
+    if len(parts) != 3:
+        return False
+    _, pid_str, host = parts
+    if host != HOSTNAME:
+        return True
+    try:
+        pid = int(pid_str)
+    except ValueError:
+        return False
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def disk_usage() -> int:
+    """Сколько байт сейчас лежит в MEDIA_DIR."""
+    if not os.path.isdir(MEDIA_DIR):
+        return 0
+    total = 0
+    for entry in os.scandir(MEDIA_DIR):
+        try:
+            total += _dir_size(entry.path) if entry.is_dir() else entry.stat().st_size
+        except FileNotFoundError:
+            pass
+    return total
+
+
+def sweep() -> None:
+    """
+    Удаляет осиротевшие каталоги: процесс-владелец умер или каталог старше
+    MEDIA_MAX_AGE. Каталоги живых процессов не трогаются никогда;
+    MEDIA_DISK_LIMIT соблюдается при приёме задач в job_workspace.
+    """
+    if not os.path.isdir(MEDIA_DIR):
+        return
+    now = time.time()
+    total = 0
+    for entry in os.scandir(MEDIA_DIR):
+        try:
+            mtime = entry.stat().st_mtime
+        except FileNotFoundError:
+            continue
+        # имена уникальны и регистрируются до создания, так что неактивный
+        # сейчас каталог активным уже не станет
+        with _active_lock:
+            active = entry.path in _active
+        if not active and (not _owner_alive(entry.name) or now - mtime > MEDIA_MAX_AGE):
+            logger.info("removing orphaned %s", entry.path)
+            _remove(entry.path)
+            continue
+        total += _dir_size(entry.path)
+    if total > MEDIA_DISK_LIMIT:
+        logger.warning("media dir holds %d bytes of live jobs, new jobs are refused until it drops "
+                       "below MEDIA_DISK_LIMIT", total)
+
+
+def _remove(path: str) -> None:
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+async def run_janitor() -> None:
+    while True:
+        try:
+            await asyncio.to_thread(sweep)
+        except Exception:
+            logger.exception("janitor sweep failed")
+        await asyncio.sleep(JANITOR_INTERVAL)
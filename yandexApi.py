@@ -0,0 +1,135 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, TypeVar
+
+from yandex_music import Client
+
+from tracing import span
+
+CLIENT_POOL_SIZE = int(os.getenv("YM_CLIENT_POOL_SIZE", "256"))
+CLIENT_TTL = float(os.getenv("YM_CLIENT_TTL", "3600"))
+YM_WORKERS = int(os.getenv("YM_WORKERS", "8"))
+YM_MAX_CONCURRENCY = int(os.getenv("YM_MAX_CONCURRENCY", str(YM_WORKERS)))
+YM_CALL_TIMEOUT = float(os.getenv("YM_CALL_TIMEOUT", "10"))
+
+logger = logging.getLogger(__name__)
+T = TypeVar("T")
+
+# token -> (инициализированный клиент, время init)
+_clients: "OrderedDict[str, tuple[Client, float]]" = OrderedDict()
+_init_locks: dict[str, threading.Lock] = {}
+_lock = threading.Lock()
+
+
+def _cached_client(token: str) -> Optional[Client]:
+    with _lock:
+        entry = _clients.get(token)
+        if entry is None:
+            return None
+        client, created = entry
+        if time.monotonic() - created >= CLIENT_TTL:
+            del _clients[token]
+            return None
+        _clients.move_to_end(token)
+        return client
+
+
+def get_client(token: str) -> Client:
+    """
+    Возвращает готовый Client для токена.
+    init() выполняется один раз на токен, дальше клиент берётся из LRU.
+    Вызывается из рабочих потоков, поэтому защищено threading.Lock.
+    """
+    client = _cached_client(token)
+    if client is not None:
+        return client
+    with _lock:
+        init_lock = _init_locks.setdefault(token, threading.Lock())
+    with init_lock:
+        try:
+            client = _cached_client(token)
+            if client is not None:
+                return client
+            client = Client(token)
+            with span("ym.client_init"):
+                client.init()
+            with _lock:
+                _clients[token] = (client, time.monotonic())
+                while len(_clients) > CLIENT_POOL_SIZE:
+                    _clients.popitem(last=False)
+        finally:
+            # и при ошибке init(), иначе лок неверного токена остаётся навсегда
+            with _lock:
+                if _init_locks.get(token) is init_lock:
+                    del _init_locks[token]
+    return client
+
+
+def drop_client(token: Optional[str]) -> None:
+    if not token:
+        return
+    with _lock:
+        _clients.pop(token, None)
+
+
+# ─── Пул потоков для синхронного yandex_music ───
+_executor = ThreadPoolExecutor(max_workers=YM_WORKERS, thread_name_prefix="ym")
+_semaphore: Optional[asyncio.Semaphore] = None
+_waiting = 0
+_running = 0
+_last_warning = 0.0
+
+
+def stats() -> dict:
+    """Глубина очереди и число активных вызовов к API Яндекса."""
+    return {"waiting": _waiting, "running": _running, "limit": YM_MAX_CONCURRENCY}
+
+
+async def run(fn: Callable[..., T], *args, timeout: Optional[float] = None) -> T:
+    """
+    Выполняет блокирующий вызов yandex_music в отдельном пуле,
+    не больше YM_MAX_CONCURRENCY одновременно.
+    timeout покрывает и ожидание в очереди, и сам вызов.
+    """
+    with span(f"ym.{getattr(fn, '__name__', 'call').lstrip('_')}"):
+        return await _run(fn, args, timeout)
+
+
+async def _run(fn: Callable[..., T], args: tuple, timeout: Optional[float]) -> T:
+    global _semaphore, _waiting, _running, _last_warning
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(YM_MAX_CONCURRENCY)
+    timeout = YM_CALL_TIMEOUT if timeout is None else timeout
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+
+    _waiting += 1
+    if _waiting > YM_MAX_CONCURRENCY and loop.time() - _last_warning > 10:
+        _last_warning = loop.time()
+        logger.warning("Yandex API queue depth: %d", _waiting)
+    try:
+        await asyncio.wait_for(_semaphore.acquire(), timeout)
+    finally:
+        _waiting -= 1
+
+    semaphore = _semaphore
+
+    def _done(_):
+        global _running
+        _running -= 1
+        semaphore.release()
+
+    _running += 1
+    # контекст копируется в поток, чтобы спаны внутри вызова попали в текущий запрос
+    future = _executor.submit(contextvars.copy_context().run, functools.partial(fn, *args))
+    # слот освобождается, только когда поток реально закончил работу,
+    # иначе зависшие вызовы переполнят пул после таймаута
+    future.add_done_callback(lambda f: loop.call_soon_threadsafe(_done, f))
+    return await asyncio.wait_for(asyncio.wrap_future(future), max(deadline - loop.time(), 0))
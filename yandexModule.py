@@ -4,17 +4,25 @@ import uuid
 import asyncio
 import json
 import html
+import logging
 from typing import Optional, List, Tuple
 
-from aiogram import Router, F
+from aiogram import Bot, Router, F
 from aiogram.types import (
     InlineQuery, InlineQueryResultArticle, InputTextMessageContent,
     InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery,
-    FSInputFile, InputMediaAudio
+    InputMediaAudio
 )
-from yandex_music import Client
 
-from storage import fetch_ym_token, cache_get_ym_info, cache_set_ym_info, cache_file_get_ym, cache_file_set_ym
+import jobs
+from media import remote_input_file
+from metrics import MEDIA_BYTES, TRANSFER_SECONDS
+import yandexApi
+from yandexApi import get_client
+from storage import (
+    fetch_ym_token, cache_get_ym, cache_set_ym, cache_get_ym_info, cache_set_ym_info,
+    cache_get_search, cache_set_search, singleflight
+)
 
 router = Router()
 
@@ -23,6 +31,8 @@ TOKEN_RE = re.compile(r"^y0[-_0-9A-Za-z]+$")
 CAPTION_LIMIT = 1024
 CAPTION_OPEN_TAG = "<blockquote expandable>"
 CAPTION_CLOSE_TAG = "</blockquote>"
+SEARCH_TIMEOUT = float(os.getenv("YM_SEARCH_TIMEOUT", "5"))
+logger = logging.getLogger(__name__)
 
 
 def parse_track_id(text: str) -> Optional[str]:
@@ -34,49 +44,62 @@ def parse_track_id(text: str) -> Optional[str]:
     return None
 
 
-def _build_caption_pages(raw_lyrics: str) -> List[str]:
-    cleaned = raw_lyrics.strip()
-    if not cleaned:
+# строка вместе с переводом строки; слово вместе с пробелом или переводом строки после него
+_LINE_RE = re.compile(r"[^\n]*\n|[^\n]+")
+_WORD_RE = re.compile(r"[^ \n]*[ \n]|[^ \n]+")
+
+
+def _paginate_lyrics(text: str) -> List[int]:
+    """
+    Границы страниц подписи: смещения в text, страница i — text[b[i]:b[i + 1]].
+    Страница после html.escape помещается в CAPTION_LIMIT вместе с тегами
+    и рвётся после пробела или перевода строки; слово длиннее страницы режется.
+    Строки, целиком влезающие на страницу, добавляются без разбора на слова.
+    """
+    if not text:
         return []
     max_payload = CAPTION_LIMIT - len(CAPTION_OPEN_TAG) - len(CAPTION_CLOSE_TAG)
-    if max_payload <= 0:
-        return []
-    pages: List[str] = []
-    current_parts: List[str] = []
-    current_len = 0
-    last_break: Optional[Tuple[int, int]] = None
-    for char in cleaned:
-        escaped_char = html.escape(char)
-        escaped_len = len(escaped_char)
-        if current_len + escaped_len > max_payload and current_parts:
-            if last_break:
-                break_idx, break_len = last_break
-                chunk = "".join(current_parts[:break_idx])
-                pages.append(f"{CAPTION_OPEN_TAG}{chunk}{CAPTION_CLOSE_TAG}")
-                current_parts = current_parts[break_idx:]
-                current_len -= break_len
-            else:
-                pages.append(f"{CAPTION_OPEN_TAG}{''.join(current_parts)}{CAPTION_CLOSE_TAG}")
-                current_parts = []
-                current_len = 0
-            last_break = None
-        current_parts.append(escaped_char)
-        current_len += escaped_len
-        if char in ("\n", " "):
-            last_break = (len(current_parts), current_len)
-    if current_parts:
-        pages.append(f"{CAPTION_OPEN_TAG}{''.join(current_parts)}{CAPTION_CLOSE_TAG}")
-    return pages
-
-
-def _get_caption_pages(info: dict) -> List[str]:
-    pages = info.get("caption_pages")
-    if pages:
-        return pages
-    legacy_text = info.get("text")
-    if legacy_text:
-        return [legacy_text]
-    return []
+    bounds = [0]
+    size = 0
+    for line in _LINE_RE.finditer(text):
+        line_len = len(html.escape(line.group()))
+        if size + line_len <= max_payload:
+            size += line_len
+            continue
+        for word in _WORD_RE.finditer(text, line.start(), line.end()):
+            word_len = len(html.escape(word.group()))
+            if size + word_len <= max_payload:
+                size += word_len
+                continue
+            if size:
+                bounds.append(word.start())
+                size = 0
+            if word_len <= max_payload:
+                size = word_len
+                continue
+            if word_len == word.end() - word.start():
+                # экранировать нечего — режем по max_payload символов
+                bounds.extend(range(word.start() + max_payload, word.end(), max_payload))
+                size = word.end() - bounds[-1]
+                continue
+            for i, char in enumerate(word.group(), word.start()):
+                char_len = len(html.escape(char))
+                if size + char_len > max_payload:
+                    bounds.append(i)
+                    size = 0
+                size += char_len
+    bounds.append(len(text))
+    return bounds
+
+
+def _split_pages(info: dict) -> List[str]:
+    """Сырой текст страниц по границам page_offsets."""
+    text, bounds = info["lyrics"], info["page_offsets"]
+    return [text[bounds[i]:bounds[i + 1]] for i in range(len(bounds) - 1)]
+
+
+def _render_caption(page: str) -> str:
+    return f"{CAPTION_OPEN_TAG}{html.escape(page)}{CAPTION_CLOSE_TAG}"
 
 
 def _build_pagination_keyboard(track_id: str, total_pages: int, current_page: int, owner_id: int) -> Optional[InlineKeyboardMarkup]:
@@ -102,11 +125,7 @@ def _build_pagination_keyboard(track_id: str, total_pages: int, current_page: in
     return InlineKeyboardMarkup(inline_keyboard=[buttons])
 
 
-def _download_track(token: str, track_id: str, dest: str) -> str:
-    client = Client(token)
-    client.init()
-    track = client.tracks([track_id])[0]
-    track.download(dest)
+def _track_info(track) -> dict:
     lyrics_text = ""
     try:
         lyrics = track.get_lyrics()
@@ -116,52 +135,112 @@ def _download_track(token: str, track_id: str, dest: str) -> str:
                 lyrics_text = fetched
     except Exception:
         lyrics_text = ""
-    caption_pages = _build_caption_pages(lyrics_text)
-    info = {
+    lyrics_text = lyrics_text.strip()
+    # текст хранится один раз, страницы — только границами в нём
+    return {
         "title": track.title,
         "artists": ", ".join(a.name for a in track.artists),
-        "caption_pages": caption_pages,
+        "lyrics": lyrics_text,
+        "page_offsets": _paginate_lyrics(lyrics_text),
     }
-    if caption_pages:
-        info["text"] = caption_pages[0]
-    return json.dumps(info)
 
 
-async def download_track(token: str, track_id: str, dest: str) -> dict:
-    info_json = await asyncio.to_thread(_download_track, token, track_id, dest)
+def _fetch_track_info(token: str, track_id: str) -> str:
+    """Только метаданные и текст трека, без скачивания аудио."""
+    client = get_client(token)
+    track = client.tracks([track_id])[0]
+    return json.dumps(_track_info(track))
+
+
+def _resolve_track(token: str, track_id: str) -> Tuple[str, str, int]:
+    """Метаданные, прямая ссылка на MP3 192 kbps и оценка размера файла в байтах."""
+    client = get_client(token)
+    track = client.tracks([track_id])[0]
+    download_info = track.get_specific_download_info("mp3", 192)
+    if download_info is None:
+        raise RuntimeError("Unavailable bitrate")
+    link = download_info.get_direct_link()
+    size = (track.duration_ms or 0) * download_info.bitrate_in_kbps // 8
+    return json.dumps(_track_info(track)), link, size
+
+
+async def fetch_track_info(token: str, track_id: str) -> dict:
+    info_json = await yandexApi.run(_fetch_track_info, token, track_id)
     return json.loads(info_json)
 
 
-async def get_track_info(token: Optional[str], track_id: str) -> dict:
-    cached = await cache_get_ym_info(track_id)
-    if cached and "caption_pages" in cached:
+async def resolve_track(token: str, track_id: str) -> Tuple[dict, str, int]:
+    info_json, link, size = await yandexApi.run(_resolve_track, token, track_id)
+    return json.loads(info_json), link, size
+
+
+async def _store_track_info(track_id: str, info: dict):
+    await cache_set_ym_info(track_id, info["title"], info["artists"], _split_pages(info))
+
+
+async def load_track_info(token: str, track_id: str, page: Optional[int] = None) -> dict:
+    """Запрашивает трек у Яндекса, кладёт в кэш и отдаёт в виде cache_get_ym_info."""
+    info = await fetch_track_info(token, track_id)
+    await _store_track_info(track_id, info)
+    pages = _split_pages(info)
+    view = {"title": info["title"], "artists": info["artists"], "page_count": len(pages)}
+    if page is not None:
+        view["page"] = pages[page] if 0 <= page < len(pages) else None
+    return view
+
+
+async def get_track_info(token: Optional[str], track_id: str, page: Optional[int] = None) -> dict:
+    """title, artists, page_count и, если задан page, сырой текст этой страницы."""
+    cached = await cache_get_ym_info(track_id, page)
+    if cached is not None:
         return cached
     if not token:
         raise RuntimeError("Token required to fetch track info")
-    dest = os.path.join("/tmp", f"tmp_{track_id}.mp3")
-    info = await download_track(token, track_id, dest)
-    os.remove(dest)
-    await cache_set_ym_info(track_id, info)
-    return info
+    return await load_track_info(token, track_id, page)
+
+
+def _search(token: str, query: str):
+    client = get_client(token)
+    return client.search(query)
+
+
+def _timeout_result() -> InlineQueryResultArticle:
+    return InlineQueryResultArticle(
+        id="timeout",
+        title="Сервис не отвечает",
+        description="Попробуйте ещё раз",
+        input_message_content=InputTextMessageContent(message_text="сервис не отвечает, попробуйте ещё раз"),
+    )
 
 
 async def search_tracks(query: str, token: str) -> List[InlineQueryResultArticle]:
-    client = Client(token)
-    client.init()
-    res = client.search(query)
-    try:
-        tracks = res["tracks"]["results"][:10]
-    except TypeError:
-        return []
-    items: List[InlineQueryResultArticle] = []
-    for tr in tracks:
-        track_id = str(tr["id"])
-        title = tr["title"]
-        artists = ", ".join(a["name"] for a in tr["artists"])
+    found = await cache_get_search("ym", query)
+    if found is None:
+        try:
+            res = await yandexApi.run(_search, token, query, timeout=SEARCH_TIMEOUT)
+        except asyncio.TimeoutError:
+            # не кэшируем: повторный запрос должен снова сходить в Яндекс
+            return [_timeout_result()]
         try:
-            cover = tr["cover_uri"].replace("%%", "100x100")
-        except KeyError:
-            cover = ""
+            tracks = res["tracks"]["results"][:10]
+        except TypeError:
+            return []
+        found = []
+        for tr in tracks:
+            try:
+                cover = tr["cover_uri"].replace("%%", "100x100")
+            except (KeyError, AttributeError):
+                cover = ""
+            found.append([
+                str(tr["id"]),
+                tr["title"],
+                ", ".join(a["name"] for a in tr["artists"]),
+                cover,
+            ])
+        await cache_set_search("ym", query, found)
+    items: List[InlineQueryResultArticle] = []
+    # компактная запись из кэша: [track_id, title, artists, cover_uri]
+    for track_id, title, artists, cover in found:
         if cover:
             cover = "https://" + cover
         msg = f"{artists} — {title}"
@@ -194,7 +273,11 @@ async def answer_download(query: InlineQuery, track_id: str):
             )
         ], cache_time=1)
         return
-    info = await get_track_info(token, track_id)
+    try:
+        info = await get_track_info(token, track_id)
+    except asyncio.TimeoutError:
+        await query.answer([_timeout_result()], cache_time=1)
+        return
     message_text = f"{info['artists']} — {info['title']}"
     await query.answer([
         InlineQueryResultArticle(
@@ -238,57 +321,69 @@ async def answer_search(query: InlineQuery, search_query_text: str):
         ], cache_time=1)
 
 
+async def _upload_track(bot: Bot, token: str, track_id: str) -> str:
+    with TRANSFER_SECONDS.labels("ym", "download").time():
+        info, link, size = await resolve_track(token, track_id)
+        audio = await remote_input_file(link, f"{track_id}.mp3", size)
+    with TRANSFER_SECONDS.labels("ym", "upload").time():
+        sent = await bot.send_audio(
+            1210881411,
+            audio=audio,
+            title=info["title"],
+            performer=info["artists"],
+        )
+    MEDIA_BYTES.labels("ym").observe(sent.audio.file_size or size)
+    file_id = sent.audio.file_id
+    await cache_set_ym(track_id, file_id, info["title"], info["artists"], _split_pages(info))
+    return file_id
+
+
+async def _download_job(bot: Bot, payload: dict) -> str:
+    token = await fetch_ym_token(payload["user_id"])
+    if not token:
+        raise RuntimeError("Token required to download track")
+    return await _upload_track(bot, token, payload["track_id"])
+
+
 async def on_download(cb: CallbackQuery):
     track_id = cb.data.split(":", 1)[1]
     token = await fetch_ym_token(cb.from_user.id)
     if not token:
         return await cb.answer("Нужен токен")
 
-    file_id = await cache_file_get_ym(track_id)
-    if file_id:
-        info = await get_track_info(token, track_id)
-        pages = _get_caption_pages(info)
-        caption = pages[0] if pages else ""
-        reply_markup = _build_pagination_keyboard(track_id, len(pages), 0, cb.from_user.id)
-        if cb.message:
-            await cb.message.edit_text("Отправляю…")
-            target = dict(chat_id=cb.message.chat.id, message_id=cb.message.message_id)
-        else:
-            await cb.bot.edit_message_text(inline_message_id=cb.inline_message_id, text="Отправляю…")
-            target = dict(inline_message_id=cb.inline_message_id)
-        media_kwargs = dict(
-            media=file_id,
-            title=info["title"],
-            performer=info["artists"],
-        )
-        if caption:
-            media_kwargs["caption"] = caption
-            media_kwargs["parse_mode"] = "HTML"
-        await cb.bot.edit_message_media(
-            media=InputMediaAudio(**media_kwargs),
-            reply_markup=reply_markup,
-            **target
-        )
-        await cb.answer()
-        return
+    # file_id и первая страница текста одним пайплайном
+    file_id, info = await cache_get_ym(track_id, 0)
+    status = "Отправляю…" if file_id else "Скачиваю…"
     if cb.message:
-        await cb.message.edit_text("Скачиваю…")
+        await cb.message.edit_text(status)
         target = dict(chat_id=cb.message.chat.id, message_id=cb.message.message_id)
     else:
-        await cb.bot.edit_message_text(inline_message_id=cb.inline_message_id, text="Скачиваю…")
+        await cb.bot.edit_message_text(inline_message_id=cb.inline_message_id, text=status)
         target = dict(inline_message_id=cb.inline_message_id)
-    path = f"/tmp/{track_id}_{cb.from_user.id}.mp3"
-    info = await download_track(token, track_id, path)
-    sent = await cb.bot.send_audio(
-        1210881411,
-        audio=FSInputFile(path),
-        title=info["title"],
-        performer=info["artists"],
-    )
-    file_id = sent.audio.file_id
-    pages = _get_caption_pages(info)
-    caption = pages[0] if pages else ""
-    reply_markup = _build_pagination_keyboard(track_id, len(pages), 0, cb.from_user.id)
+    if not file_id:
+        # одновременные нажатия на один трек (в т.ч. в других процессах) ждут одну загрузку
+        try:
+            file_id = await singleflight(
+                f"ym:{track_id}:mp3",
+                lambda: jobs.run("ym", {"track_id": track_id, "user_id": cb.from_user.id}, cb.bot),
+            )
+        except (jobs.JobError, asyncio.TimeoutError) as e:
+            logger.warning("ym download %s failed: %s", track_id, e)
+            await cb.bot.edit_message_text(text="Не удалось скачать, попробуйте ещё раз", **target)
+            await cb.answer()
+            return
+    if info is None:
+        try:
+            info = await get_track_info(token, track_id, 0)
+        except asyncio.TimeoutError:
+            # файл уже есть: отдаём его без текста, название и исполнитель зашиты при загрузке
+            logger.warning("ym track info %s timed out, sending audio without lyrics", track_id)
+            await cb.bot.edit_message_media(media=InputMediaAudio(media=file_id), **target)
+            await cb.answer()
+            return
+    total_pages = info["page_count"]
+    caption = _render_caption(info["page"]) if info["page"] else ""
+    reply_markup = _build_pagination_keyboard(track_id, total_pages, 0, cb.from_user.id)
     media_kwargs = dict(
         media=file_id,
         title=info["title"],
@@ -302,10 +397,7 @@ async def on_download(cb: CallbackQuery):
         reply_markup=reply_markup,
         **target
     )
-    await cache_file_set_ym(track_id, file_id)
-    await cache_set_ym_info(track_id, info)
     await cb.answer()
-    os.remove(path)
 
 
 async def on_caption_page(cb: CallbackQuery):
@@ -323,25 +415,27 @@ async def on_caption_page(cb: CallbackQuery):
     except (ValueError, AttributeError):
         await cb.answer()
         return
-    token = await fetch_ym_token(owner_id)
-    cached_info = await cache_get_ym_info(track_id)
-    if cached_info and "caption_pages" in cached_info:
-        info = cached_info
-    else:
+    page_index = max(page_index, 0)
+    # обычно хватает одного HMGET: метаданные и нужная страница
+    info = await cache_get_ym_info(track_id, page_index)
+    if info is None:
+        token = await fetch_ym_token(owner_id)
         if not token:
             await cb.answer("Текст недоступен", show_alert=True)
             return
-        info = await get_track_info(token, track_id)
-    pages = _get_caption_pages(info)
-    if not pages:
+        try:
+            info = await load_track_info(token, track_id, page_index)
+        except asyncio.TimeoutError:
+            await cb.answer("Сервис не отвечает, попробуйте ещё раз", show_alert=True)
+            return
+    total_pages = info["page_count"]
+    if page_index >= total_pages > 0:
+        page_index = total_pages - 1
+        info = await cache_get_ym_info(track_id, page_index) or info
+    if not info.get("page"):
         await cb.answer("Текст недоступен", show_alert=True)
         return
-    total_pages = len(pages)
-    if page_index < 0:
-        page_index = 0
-    if page_index >= total_pages:
-        page_index = total_pages - 1
-    caption = pages[page_index]
+    caption = _render_caption(info["page"])
     reply_markup = _build_pagination_keyboard(track_id, total_pages, page_index, owner_id)
     if cb.message:
         await cb.bot.edit_message_caption(
@@ -361,5 +455,6 @@ async def on_caption_page(cb: CallbackQuery):
     await cb.answer(f"Страница {page_index + 1} из {total_pages}")
 
 
+jobs.register("ym", _download_job)
 router.callback_query.register(on_download, F.data.startswith("ym_dl:"))
 router.callback_query.register(on_caption_page, F.data.startswith("ym_pg:"))
@@ -1,46 +1,41 @@
 import asyncio
-import datetime
+import logging
 import os
 import re
 import uuid
+from typing import Callable, List, Optional
 
-import yt_dlp
-from aiogram import Router, F
+import aiohttp
+from aiogram import Bot, Router, F
 from aiogram.types import InlineQuery, InlineQueryResultArticle, InputTextMessageContent, InlineKeyboardMarkup, \
     InlineKeyboardButton, InlineQueryResultPhoto, CallbackQuery, InputMediaAudio, InputMediaVideo, FSInputFile
-import json
-import urllib.request
-import urllib.parse
-
 from urllib.parse import urlparse, parse_qs
 
+import jobs
+import ytdlpWorker
+from httpClient import get_session
+from workspace import job_workspace
+from progress import ProgressReporter, format_progress
+from metrics import MEDIA_BYTES, TRANSFER_SECONDS
+from tracing import traced
+from storage import (
+    singleflight, cache_file_get_yt, cache_file_set_yt, cache_get_yt_info, cache_set_yt_info,
+    cache_get_yt_extract, cache_set_yt_extract
+)
+
 OEMBED = "https://www.youtube.com/oembed"
 
 router = Router()
 
 YOUTUBE_PATTERNS = [re.compile(r"https://(?:www\.)?youtube\.com"), re.compile(r"https://youtu\.be")]
-vidInfos = {}
-
-class _StatusLogger:
-    """
-    Перехватывает сообщения yt-dlp и выводит изменения
-    красным цветом (ANSI 31m).
-    """
+MAX_HEIGHT = 1080
+logger = logging.getLogger(__name__)
 
-    def __init__(self, queue: asyncio.Queue) -> None:
-        self._last = None
-        self._last_time = datetime.datetime(1970, 1, 1, 0, 0, 0)
-        self._queue = queue
-
-    def _print(self, msg: str) -> None:
-        now = datetime.datetime.now()
-        if msg != self._last and now - self._last_time > datetime.timedelta(milliseconds=500):
-            print(f"\033[31m{msg}\033[0m")
-            self._queue.put_nowait(msg)
-            self._last = msg
-            self._last_time = now
-
-    debug = info = warning = error = _print
+# поля info_dict, не нужные для выбора формата и загрузки, но раздувающие кэш
+_EXTRACT_DROP_KEYS = ("automatic_captions", "subtitles", "heatmap", "thumbnails", "description")
+# cookies и заголовки конкретного запроса: yt-dlp загружает их обратно в process_ie_result
+_EXTRACT_PRIVATE_KEYS = ("cookies", "http_headers")
+_extracting: dict[str, asyncio.Task] = {}
 
 def is_youtube_link(text: str) -> bool:
     return any(p.search(text) for p in YOUTUBE_PATTERNS)
@@ -66,14 +61,20 @@ def extract_video_id(url):
     return None
 
 
+@traced("yt.oembed")
 async def short_info(url: str, *, timeout: float = 2.0) -> dict:
     """
     Возвращает лёгкую карточку ролика
     (title / autor / preview) за ~0.1 с.
     """
-    qs = urllib.parse.urlencode({"url": url, "format": "json"})
-    with urllib.request.urlopen(f"{OEMBED}?{qs}", timeout=timeout) as r:
-        data = json.load(r)
+    session = await get_session()
+    async with session.get(
+        OEMBED,
+        params={"url": url, "format": "json"},
+        timeout=aiohttp.ClientTimeout(total=timeout),
+    ) as r:
+        r.raise_for_status()
+        data = await r.json(content_type=None)
 
     return {
         "title": data.get("title"),
@@ -84,24 +85,100 @@ async def short_info(url: str, *, timeout: float = 2.0) -> dict:
         "id": extract_video_id(url),
     }
 
-async def download_video(url: str, fmt: str, cb: CallbackQuery, vid: str) -> dict:
+async def get_video_info(video_id: str, url: Optional[str] = None) -> dict:
+    """Карточка из общего кэша; при промахе (рестарт, другая реплика) — заново из oEmbed."""
+    info = await cache_get_yt_info(video_id)
+    if info is None:
+        info = await short_info(url or f"https://www.youtube.com/watch?v={video_id}")
+        await cache_set_yt_info(video_id, info)
+    return info
+
+
+def _cookie_opts(user_id: int) -> dict:
+    opts = {"nocheckcertificate": True}
+    cookie_path = f"/app/cookies/{user_id}.txt"
+    if os.path.exists(cookie_path):
+        opts["cookiefile"] = cookie_path
+    return opts
+
+
+def _available_heights(extracted: dict) -> List[int]:
+    heights = {
+        f.get("height") for f in extracted.get("formats") or []
+        if f.get("height") and f.get("vcodec") != "none"
+    }
+    return sorted(h for h in heights if h <= MAX_HEIGHT)
+
+
+def _strip_private(extracted: dict) -> None:
+    for key in _EXTRACT_DROP_KEYS + _EXTRACT_PRIVATE_KEYS:
+        extracted.pop(key, None)
+    for fmt in (extracted.get("formats") or []) + (extracted.get("requested_formats") or []):
+        for key in _EXTRACT_PRIVATE_KEYS:
+            fmt.pop(key, None)
+
+
+async def _extract_formats(video_id: str, url: str) -> Optional[dict]:
+    if await cache_get_yt_extract(video_id) is not None:
+        return None
+    # кэш общий для всех пользователей, поэтому без чьих-либо cookies:
+    # ролики, доступные только с cookies, экстрагирует сама загрузка
+    extracted = await ytdlpWorker.extract(url, {"nocheckcertificate": True})
+    if extracted is None:
+        # пул занят загрузками — карточка обойдётся статичным списком разрешений
+        return None
+    _strip_private(extracted)
+    await cache_set_yt_extract(video_id, extracted)
+    heights = _available_heights(extracted)
+    if heights:
+        info = await get_video_info(video_id, url)
+        await cache_set_yt_info(video_id, dict(info, resolutions=heights))
+    return extracted
+
+
+def _log_extract_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("yt-dlp extraction failed: %s", task.exception())
+
+
+def prefetch_formats(video_id: str, url: str) -> asyncio.Task:
+    """
+    Фоновая экстракция yt-dlp, пока пользователь смотрит на карточку;
+    пропускается, если пул yt-dlp занят.
+    Результат попадает в общий кэш: им пользуется загрузка (в т.ч. в worker.py),
+    а реальные разрешения появятся в карточке при следующем запросе.
+    """
+    task = _extracting.get(video_id)
+    if task is None:
+        task = asyncio.create_task(_extract_formats(video_id, url))
+        _extracting[video_id] = task
+        task.add_done_callback(lambda _: _extracting.pop(video_id, None))
+        task.add_done_callback(_log_extract_error)
+    return task
+
+
+async def download_video(url: str, fmt: str, vid: str, workdir: str, *, user_id: int,
+                         on_progress: Callable[[dict], None],
+                         extracted: Optional[dict] = None) -> dict:
     """
-    Скачивает ролик / аудиодорожку во временный каталог.
+    Скачивает ролик / аудиодорожку в каталог задачи workdir.
 
     Параметры
     ----------
-    url      – ссылка на ролик
-    fmt      – 'audio'  ▸ MP3 bestaudio
-               '<num>'  ▸ MP4 указанной высоты (1080, 720…)
+    url       – ссылка на ролик
+    fmt       – 'audio'  ▸ MP3 bestaudio
+                '<num>'  ▸ MP4 указанной высоты (1080, 720…)
+    workdir   – каталог задачи из workspace.job_workspace
+    user_id   – владелец cookies.txt
+    on_progress – получает события прогресса yt-dlp
+    extracted – готовый результат экстракции, если он уже есть
 
     Возврат
     -------
-    {'type': 'audio'|'video', 'file': '/tmp/<id>.<ext>', 'id': <video_id>}
+    {'type': 'audio'|'video', 'file': '<workdir>/<id>.<ext>', 'id': <video_id>}
     """
 
-    target_dir = "/tmp"
-    os.makedirs(target_dir, exist_ok=True)
-    outtmpl = os.path.join(target_dir, f"{vid}.%(ext)s")
+    outtmpl = os.path.join(workdir, f"{vid}.%(ext)s")
 
     # ─── Формат, пост-процессоры, результ. расширение ───
     if fmt == "audio":
@@ -119,39 +196,22 @@ async def download_video(url: str, fmt: str, cb: CallbackQuery, vid: str) -> dic
         )
         post, ext, mediatype = [], "mp4", "video"
 
-    queue = asyncio.Queue()
-    logger = _StatusLogger(queue)
-
-    async def consume_log_queue():
-        while True:
-            try:
-                msg = await asyncio.wait_for(queue.get(), timeout=5)
-                await cb.bot.edit_message_text(inline_message_id=cb.inline_message_id, text=msg)
-            except asyncio.TimeoutError:
-                break
-
     ydl_opts = {
         "format": dl_format,
         "outtmpl": outtmpl,
-        "logger": logger,
         "postprocessors": post,
         # подавим лишний шелл-вывод FFmpeg
         "postprocessor_args": ["-loglevel", "error"],
         # ускоряем фильтром только нужных форматов
         "merge_output_format": "mp4",
         "quiet": True,
-        "nocheckcertificate": True,
+        **_cookie_opts(user_id),
     }
-    consumer_task = asyncio.create_task(consume_log_queue())
-    cookie_path = f"/app/cookies/{cb.from_user.id}.txt"
-    if os.path.exists(cookie_path):
-        ydl_opts["cookiefile"] = cookie_path
 
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        ydl.download([url])
-    await consumer_task
+    # yt-dlp и ffmpeg работают в отдельном процессе, логгер — там же
+    await ytdlpWorker.download(url, ydl_opts, on_progress, info=extracted)
 
-    final_path = os.path.join(target_dir, f"{vid}.{ext}")
+    final_path = os.path.join(workdir, f"{vid}.{ext}")
     return {"type": mediatype, "file": final_path, "id": vid}
 
 
@@ -191,8 +251,10 @@ async def answer_download(query: InlineQuery, link: str):
     #     ], cache_time=1)
     #     return
 
-    info = await short_info(link)
-    vidInfos[video_id] = info
+    # отвечаем сразу: разрешения из кэша или стандартный список,
+    # экстракция идёт в фоне и уточнит карточку для следующих запросов
+    info = await get_video_info(video_id, link)
+    prefetch_formats(video_id, link)
     message_text = f"{info['title']} — {info['author']}"
     await query.answer([
         InlineQueryResultPhoto(
@@ -220,36 +282,88 @@ async def answer_download(query: InlineQuery, link: str):
     ], cache_time=1)
 
 
+async def _download_job(bot: Bot, payload: dict) -> str:
+    """Скачивает ролик и загружает его в Telegram; payload приходит из jobs.run."""
+    video_id, format, info = payload["video_id"], payload["format"], payload["info"]
+    target = payload["target"]
+
+    async def send_status(text: str):
+        await bot.edit_message_text(text=text, **target)
+
+    reporter = ProgressReporter(send_status)
+    extracted = await cache_get_yt_extract(video_id)
+    async with job_workspace("yt") as workdir:
+        try:
+            with TRANSFER_SECONDS.labels("yt", "download").time():
+                result = await download_video(video_id, format, video_id, workdir,
+                                              user_id=payload["user_id"],
+                                              on_progress=lambda e: reporter.update(format_progress(e)),
+                                              extracted=extracted)
+        except Exception:
+            await reporter.close("Не удалось скачать")
+            raise
+        await reporter.close("Отправляю…")
+        MEDIA_BYTES.labels("yt").observe(os.path.getsize(result["file"]))
+        with TRANSFER_SECONDS.labels("yt", "upload").time():
+            if result["type"] == "video":
+                sent = await bot.send_video(
+                    1210881411,
+                    video=FSInputFile(result["file"])
+                )
+                file_id = sent.video.file_id
+            else:
+                sent = await bot.send_audio(
+                    1210881411,
+                    audio=FSInputFile(result["file"]),
+                    title=info["title"],
+                    performer=info["author"],
+                )
+                file_id = sent.audio.file_id
+    await cache_file_set_yt(video_id, format, file_id, info["title"], info["author"])
+    return file_id
+
+
 async def on_download(cb: CallbackQuery):
     _, video_id, format = cb.data.split(":")
-    info = vidInfos[video_id]
+    cached = await cache_file_get_yt(video_id, format)
+    status = "Отправляю…" if cached else "Скачиваю UwU…"
     if cb.message:
-        await cb.message.edit_text("Скачиваю UwU…")
+        await cb.message.edit_text(status)
         target = dict(chat_id=cb.message.chat.id, message_id=cb.message.message_id)
     else:
-        await cb.bot.edit_message_text(inline_message_id=cb.inline_message_id, text="Скачиваю UwU…")
+        await cb.bot.edit_message_text(inline_message_id=cb.inline_message_id, text=status)
         target = dict(inline_message_id=cb.inline_message_id)
-    result = await download_video(video_id, format, cb, video_id)
-    if result["type"] == "video":
-        sent = await cb.bot.send_video(
-            1210881411,
-            video=FSInputFile(result["file"])
-        )
-        await cb.bot.edit_message_media(
-            media=InputMediaVideo(media=sent.video.file_id),
-            **target
-        )
-    elif result["type"] == "audio":
-        sent = await cb.bot.send_audio(
-            1210881411,
-            audio=FSInputFile(result["file"]),
-            title=info["title"],
-            performer=info["author_name"],
-        )
-        await cb.bot.edit_message_media(
-            media=InputMediaAudio(media=sent.audio.file_id, title=info["title"], performer=info["author_name"]),
-            **target
-        )
+    if cached:
+        file_id, title, author = cached["file_id"], cached["title"], cached["author"]
+    else:
+        info = await get_video_info(video_id)
+        try:
+            file_id = await singleflight(
+                f"yt:{video_id}:{format}",
+                lambda: jobs.run("yt", {
+                    "video_id": video_id,
+                    "format": format,
+                    "info": info,
+                    "user_id": cb.from_user.id,
+                    "target": target,
+                }, cb.bot),
+            )
+        except (jobs.JobError, asyncio.TimeoutError) as e:
+            if getattr(e, "busy", False):
+                text = "Слишком много загрузок, попробуйте позже"
+            else:
+                logger.warning("yt download %s:%s failed: %s", video_id, format, e)
+                text = "Не удалось скачать, попробуйте ещё раз"
+            await cb.bot.edit_message_text(text=text, **target)
+            await cb.answer()
+            return
+        title, author = info["title"], info["author"]
+    if format == "audio":
+        media = InputMediaAudio(media=file_id, title=title, performer=author)
+    else:
+        media = InputMediaVideo(media=file_id)
+    await cb.bot.edit_message_media(media=media, **target)
 
 
+jobs.register("yt", _download_job)
 router.callback_query.register(on_download, F.data.startswith("yt_dl:"))
@@ -0,0 +1,215 @@
+import asyncio
+import contextlib
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Optional
+
+import yt_dlp
+
+from tracing import traced
+
+YT_WORKERS = int(os.getenv("YT_WORKERS", str(os.cpu_count() or 1)))
+YT_MAX_CONCURRENCY = int(os.getenv("YT_MAX_CONCURRENCY", str(YT_WORKERS)))
+YT_QUEUE_LIMIT = int(os.getenv("YT_QUEUE_LIMIT", "32"))
+# фоновые экстракции для карточек: не больше стольких сразу и только в свободные слоты
+YT_PREFETCH_CONCURRENCY = int(os.getenv("YT_PREFETCH_CONCURRENCY", "1"))
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    # jobs.JobError.busy: пользователю «попробуйте позже», а не ошибка
+    busy = True
+
+
+class _YdlLogger:
+    """
+    Сообщения yt-dlp в logging этого модуля на уровне DEBUG:
+    прогресс идёт через _ProgressHook, ошибки приходят исключением.
+    """
+
+    def debug(self, msg: str) -> None:
+        logger.debug("%s", msg)
+
+    info = warning = error = debug
+
+
+class _ProgressHook:
+    """
+    progress_hooks / postprocessor_hooks yt-dlp в дочернем процессе.
+    Хуки зовутся на каждый чанк, поэтому в очередь менеджера уходит
+    не чаще раза в PROGRESS_SAMPLE секунд, плюс смена статуса.
+    """
+
+    PROGRESS_SAMPLE = 0.5
+
+    def __init__(self, progress_queue) -> None:
+        self._queue = progress_queue
+        self._last_status = None
+        self._last_time = 0.0
+
+    def download(self, d: dict) -> None:
+        now = time.monotonic()
+        status = d.get("status")
+        if status == self._last_status and now - self._last_time < self.PROGRESS_SAMPLE:
+            return
+        self._last_status, self._last_time = status, now
+        self._queue.put_nowait({
+            "status": status,
+            "downloaded": d.get("downloaded_bytes") or 0,
+            "total": d.get("total_bytes") or d.get("total_bytes_estimate"),
+            "speed": d.get("speed"),
+            "eta": d.get("eta"),
+        })
+
+    def postprocess(self, d: dict) -> None:
+        if d.get("status") == "started" and self._last_status != "processing":
+            self._last_status = "processing"
+            self._queue.put_nowait({"status": "processing"})
+
+
+def _run_ydl(url: str, opts: dict, progress_queue, info: Optional[dict] = None) -> None:
+    """Выполняется в дочернем процессе: прогресс уходит в очередь менеджера."""
+    hook = _ProgressHook(progress_queue)
+    opts = dict(
+        opts,
+        logger=_YdlLogger(),
+        progress_hooks=[hook.download],
+        postprocessor_hooks=[hook.postprocess],
+    )
+    try:
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            if info is None:
+                ydl.download([url])
+                return
+            try:
+                # как --load-info-json: выбор формата и загрузка без повторной экстракции
+                ydl.process_ie_result(info, download=True)
+            except yt_dlp.utils.DownloadError:
+                # ссылки на форматы протухли — экстрагируем заново
+                ydl.download([url])
+    except yt_dlp.utils.YoutubeDLError as e:
+        # исключения yt-dlp держат exc_info и не переживают pickle между процессами
+        raise RuntimeError(str(e)) from None
+
+
+def _extract(url: str, opts: dict) -> dict:
+    opts = dict(opts, quiet=True, skip_download=True)
+    try:
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            info = ydl.extract_info(url, download=False)
+            return ydl.sanitize_info(info, True)
+    except yt_dlp.utils.YoutubeDLError as e:
+        raise RuntimeError(str(e)) from None
+
+
+# spawn: родитель многопоточный (пулы aiogram / yandex), fork здесь небезопасен
+_ctx = multiprocessing.get_context("spawn")
+_pool: Optional[ProcessPoolExecutor] = None
+_manager = None
+_semaphore: Optional[asyncio.Semaphore] = None
+_waiting = 0
+_running = 0
+_prefetching = 0
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool, _manager
+    with _pool_lock:
+        if _pool is None:
+            _manager = _ctx.Manager()
+            _pool = ProcessPoolExecutor(max_workers=YT_WORKERS, mp_context=_ctx)
+    return _pool, _manager
+
+
+def stats() -> dict:
+    return {"waiting": _waiting, "running": _running, "prefetching": _prefetching, "limit": YT_MAX_CONCURRENCY}
+
+
+def _notify(on_progress: Callable[[dict], None], event: dict) -> None:
+    try:
+        on_progress(event)
+    except Exception:
+        logger.exception("progress callback failed")
+
+
+@contextlib.asynccontextmanager
+async def _slot(on_progress: Optional[Callable[[dict], None]] = None):
+    """
+    Слот пула: не больше YT_MAX_CONCURRENCY вызовов yt-dlp одновременно,
+    остальные ждут в очереди длиной до YT_QUEUE_LIMIT, сверх неё — QueueFull.
+    """
+    global _semaphore, _waiting, _running
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(YT_MAX_CONCURRENCY)
+    if _waiting >= YT_QUEUE_LIMIT:
+        raise QueueFull
+    _waiting += 1
+    try:
+        if _semaphore.locked() and on_progress is not None:
+            _notify(on_progress, {"status": "queued", "position": _waiting})
+        await _semaphore.acquire()
+    finally:
+        _waiting -= 1
+
+    _running += 1
+    try:
+        yield
+    finally:
+        _running -= 1
+        _semaphore.release()
+
+
+@traced("yt.extract")
+async def extract(url: str, opts: dict) -> Optional[dict]:
+    """
+    Низкоприоритетный extract_info(download=False) в пуле процессов;
+    результат пригоден для download(info=...).
+    Занимает слот только если он свободен прямо сейчас и загрузки не ждут в очереди,
+    иначе сразу возвращает None: загрузки не стоят за экстракциями и не получают QueueFull.
+    """
+    global _semaphore, _running, _prefetching
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(YT_MAX_CONCURRENCY)
+    if _prefetching >= YT_PREFETCH_CONCURRENCY or _waiting or _semaphore.locked():
+        return None
+    # слот свободен, поэтому acquire не ждёт
+    await _semaphore.acquire()
+    _prefetching += 1
+    _running += 1
+    try:
+        pool, _ = await asyncio.to_thread(_get_pool)
+        return await asyncio.get_running_loop().run_in_executor(pool, _extract, url, opts)
+    finally:
+        _running -= 1
+        _prefetching -= 1
+        _semaphore.release()
+
+
+@traced("yt.download")
+async def download(url: str, opts: dict, on_progress: Callable[[dict], None],
+                   info: Optional[dict] = None) -> None:
+    """
+    Запускает yt-dlp в пуле процессов под лимитом _slot.
+    События прогресса (см. progress.format_progress) передаются в on_progress.
+    info — результат extract(): тогда повторная экстракция не нужна.
+    """
+    async with _slot(on_progress):
+        pool, manager = await asyncio.to_thread(_get_pool)
+        progress_queue = await asyncio.to_thread(manager.Queue)
+        future = asyncio.get_running_loop().run_in_executor(pool, _run_ydl, url, opts, progress_queue, info)
+        while True:
+            try:
+                event = await asyncio.to_thread(progress_queue.get, True, 0.5)
+            except queue.Empty:
+                if future.done():
+                    break
+                continue
+            _notify(on_progress, event)
+        await future